@@ -27,19 +27,48 @@ db_handler = handlers.DB(st_path=conf.Storage.db_path)
 data_handler = handlers.Data(
     st_path=conf.Storage.data_cache_path,
     data_api_url=conf.Data.api_url,
-    max_age=conf.Data.max_age
+    max_downloads=conf.Data.max_downloads,
+    max_prefetches=conf.Data.max_prefetches,
+    cache_streams=conf.Data.cache_streams,
+    cache_frames=conf.Data.cache_frames,
+    cache_size=conf.Data.cache_size
+)
+storage_handler = handlers.Storage(
+    st_path=conf.Storage.models_path,
+    data_format=conf.Models.format,
+    codec=conf.Models.codec,
+    level=conf.Models.level
 )
 jobs_handler = handlers.Jobs(
     db_handler=db_handler,
     data_handler=data_handler,
+    storage_handler=storage_handler,
     check_delay=conf.Jobs.check,
-    max_jobs=conf.Jobs.max_num
+    max_jobs=conf.Jobs.max_num,
+    max_memory=conf.Jobs.max_memory,
+    max_cpus=conf.Jobs.max_cpus,
+    cpu_affinity=conf.Jobs.cpu_affinity,
+    job_timeout=conf.Jobs.job_timeout,
+    job_max_memory=conf.Jobs.job_max_memory,
+    lease_time=conf.Jobs.lease_time,
+    memory_factor=conf.Jobs.memory_factor,
+    compact_data=conf.Jobs.compact_data,
+    cache_features=conf.Jobs.cache_features,
+    incremental_features=conf.Jobs.incremental_features,
+    track_data_size=conf.Jobs.skd_min_growth > 0,
+    grid_threads=conf.Jobs.grid_threads,
+    worker_max_jobs=conf.Jobs.worker_max_jobs,
+    worker_max_memory=conf.Jobs.worker_max_memory
 )
 skd_handler = handlers.Scheduler(
     job_handler=jobs_handler,
     db_handler=db_handler,
     data_handler=data_handler,
-    delay=conf.Jobs.skd_delay
+    delay=conf.Jobs.skd_delay,
+    max_requests=conf.Jobs.skd_max_requests,
+    budget=conf.Jobs.skd_budget,
+    priority=conf.Jobs.skd_priority,
+    min_growth=conf.Jobs.skd_min_growth
 )
 
 app = falcon.API()
@@ -47,16 +76,19 @@ app = falcon.API()
 app.req_options.strip_url_path_trailing_slash = True
 
 routes = (
-    ("/models", api.Models(db_handler=db_handler, jobs_handler=jobs_handler)),
-    ("/models/{model_id}", api.Model(db_handler=db_handler)),
+    ("/models", api.Models(db_handler=db_handler, jobs_handler=jobs_handler, data_handler=data_handler)),
+    ("/models/{model_id}", api.Model(db_handler=db_handler, storage_handler=storage_handler)),
+    ("/models/{model_id}/data", api.ModelData(db_handler=db_handler, storage_handler=storage_handler)),
     ("/jobs", api.Jobs(db_handler=db_handler, jobs_handler=jobs_handler)),
-    ("/jobs/{job_id}", api.Job(db_handler=db_handler, jobs_handler=jobs_handler))
+    ("/jobs/{job_id}", api.Job(db_handler=db_handler, jobs_handler=jobs_handler)),
+    ("/leases", api.Leases(jobs_handler=jobs_handler)),
+    ("/leases/{lease_id}", api.Lease(jobs_handler=jobs_handler))
 )
 
 for route in routes:
     app.add_route(*route)
 
-data_handler.purge_cache()
+data_handler.clean_cache()
 jobs_handler.start()
 data_handler.start()
 if conf.Jobs.skd_enabled:
@@ -22,6 +22,8 @@ from . import handlers
 from . import models
 import falcon
 import json
+import base64
+import os
 
 
 logger = getLogger(__name__.split(".", 1)[-1])
@@ -36,9 +38,10 @@ def reqErrorLog(req, ex):
 
 
 class Models:
-    def __init__(self, db_handler: handlers.DB, jobs_handler: handlers.Jobs):
+    def __init__(self, db_handler: handlers.DB, jobs_handler: handlers.Jobs, data_handler: handlers.Data):
         self.__db_handler = db_handler
         self.__jobs_handler = jobs_handler
+        self.__data_handler = data_handler
 
     def on_get(self, req: falcon.request.Request, resp: falcon.response.Response):
         reqDebugLog(req)
@@ -55,18 +58,25 @@ class Models:
         try:
             model_req = models.ModelRequest(json.load(req.bounded_stream))
             model_resp = models.ModelResponse(available=list(), pending=list())
+            created = list()
             for m_id, m_conf in handlers.configs.get_model_id_config_list(service_id=model_req.service_id, config=model_req.ml_config):
                 try:
-                    model = models.Model(json.loads(self.__db_handler.get(b"models-", m_id.encode())))
-                    if model.data:
-                        model_resp.available.append(m_id)
-                    else:
-                        model_resp.pending.append(m_id)
+                    self.__db_handler.get(b"available-", m_id.encode())
+                    model_resp.available.append(m_id)
+                    continue
+                except KeyError:
+                    pass
+                try:
+                    self.__db_handler.get(b"models-", m_id.encode())
+                    model_resp.pending.append(m_id)
                 except KeyError:
                     model = models.Model(service_id=model_req.service_id, id=m_id, config=m_conf)
                     self.__db_handler.put(b"models-", model.id.encode(), json.dumps(dict(model)).encode())
-                    self.__jobs_handler.create(model_id=model.id)
                     model_resp.pending.append(m_id)
+                    created.append(m_id)
+            if created:
+                self.__jobs_handler.create_grid(model_ids=created)
+                self.__data_handler.prefetch(source_id=model_req.service_id)
             resp.content_type = falcon.MEDIA_JSON
             resp.body = json.dumps(dict(model_resp))
             resp.status = falcon.HTTP_200
@@ -76,14 +86,23 @@ class Models:
 
 
 class Model:
-    def __init__(self, db_handler: handlers.DB):
+    def __init__(self, db_handler: handlers.DB, storage_handler: handlers.Storage):
         self.__db_handler = db_handler
+        self.__storage_handler = storage_handler
 
     def on_get(self, req: falcon.request.Request, resp: falcon.response.Response, model_id: str):
         reqDebugLog(req)
         try:
+            model = json.loads(self.__db_handler.get(b"models-", model_id.encode()))
+            if req.get_param_as_bool("data", default=True) and model.get("data_digest"):
+                try:
+                    model["data"] = base64.standard_b64encode(self.__storage_handler.read(model_id, model["data_digest"])).decode()
+                except KeyError:
+                    # the model was retrained after its metadata was read
+                    model = json.loads(self.__db_handler.get(b"models-", model_id.encode()))
+                    model["data"] = base64.standard_b64encode(self.__storage_handler.read(model_id, model["data_digest"])).decode()
             resp.content_type = falcon.MEDIA_JSON
-            resp.body = self.__db_handler.get(b"models-", model_id.encode())
+            resp.body = json.dumps(model)
             resp.status = falcon.HTTP_200
         except KeyError as ex:
             resp.status = falcon.HTTP_404
@@ -95,8 +114,113 @@ class Model:
     def on_delete(self, req: falcon.request.Request, resp: falcon.response.Response, model_id: str):
         reqDebugLog(req)
         try:
+            model_item = models.Model(json.loads(self.__db_handler.get(b"models-", model_id.encode())))
+            self.__db_handler.delete(b"available-", model_id.encode())
             self.__db_handler.delete(b"models-", model_id.encode())
+            if model_item.data_digest:
+                self.__storage_handler.delete(model_id, model_item.data_digest)
             resp.status = falcon.HTTP_200
+        except KeyError as ex:
+            resp.status = falcon.HTTP_404
+            reqErrorLog(req, ex)
+        except Exception as ex:
+            resp.status = falcon.HTTP_500
+            reqErrorLog(req, ex)
+
+
+class ModelData:
+    __chunk_size = 65536
+
+    def __init__(self, db_handler: handlers.DB, storage_handler: handlers.Storage):
+        self.__db_handler = db_handler
+        self.__storage_handler = storage_handler
+
+    def __read(self, file, length: int):
+        try:
+            while length > 0:
+                chunk = file.read(min(self.__chunk_size, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+        finally:
+            file.close()
+
+    def __get_model(self, model_id: str) -> models.Model:
+        return models.Model(json.loads(self.__db_handler.get(b"models-", model_id.encode())))
+
+    def __respond(self, req: falcon.request.Request, resp: falcon.response.Response, model_id: str, send_body: bool):
+        self.__db_handler.get(b"available-", model_id.encode())
+        model_item = self.__get_model(model_id)
+        resp.accept_ranges = "bytes"
+        if req.if_none_match and any(tag in ("*", model_item.data_digest) for tag in req.if_none_match):
+            resp.etag = '"{}"'.format(model_item.data_digest)
+            resp.status = falcon.HTTP_304
+            return
+        try:
+            file = self.__storage_handler.open(model_id, model_item.data_digest)
+        except KeyError:
+            # the model was retrained after its metadata was read
+            model_item = self.__get_model(model_id)
+            file = self.__storage_handler.open(model_id, model_item.data_digest)
+        # headers are taken from the metadata of the opened binary, files of a digest never change
+        resp.etag = '"{}"'.format(model_item.data_digest)
+        resp.set_header("Digest", "sha-256={}".format(base64.standard_b64encode(bytes.fromhex(model_item.data_digest)).decode()))
+        size = os.fstat(file.fileno()).st_size
+        start = 0
+        end = size - 1
+        resp.status = falcon.HTTP_200
+        # ranges of a different version of the binary must not be combined, invalid ranges are ignored
+        byte_range = req.range if req.get_header("If-Range") in (None, resp.etag) else None
+        if byte_range and 0 <= byte_range[1] < byte_range[0]:
+            byte_range = None
+        if byte_range:
+            start, end = byte_range
+            if start < 0:
+                start = max(size + start, 0)
+                end = size - 1
+            elif end < 0 or end >= size:
+                end = size - 1
+            if start >= size:
+                resp.set_header("Content-Range", "bytes */{}".format(size))
+                resp.status = falcon.HTTP_416
+                file.close()
+                return
+            resp.content_range = (start, end, size)
+            resp.status = falcon.HTTP_206
+        resp.content_type = self.__storage_handler.get_content_type(model_item.data_codec)
+        resp.content_length = end - start + 1
+        if not send_body:
+            file.close()
+        elif start or end < size - 1:
+            file.seek(start)
+            resp.stream = self.__read(file, end - start + 1)
+        else:
+            # served from the file without loading the binary into memory
+            resp.stream = file
+
+    def on_get(self, req: falcon.request.Request, resp: falcon.response.Response, model_id: str):
+        reqDebugLog(req)
+        try:
+            self.__respond(req, resp, model_id, True)
+        except falcon.HTTPError:
+            raise
+        except KeyError as ex:
+            resp.status = falcon.HTTP_404
+            reqErrorLog(req, ex)
+        except Exception as ex:
+            resp.status = falcon.HTTP_500
+            reqErrorLog(req, ex)
+
+    def on_head(self, req: falcon.request.Request, resp: falcon.response.Response, model_id: str):
+        reqDebugLog(req)
+        try:
+            self.__respond(req, resp, model_id, False)
+        except falcon.HTTPError:
+            raise
+        except KeyError as ex:
+            resp.status = falcon.HTTP_404
+            reqErrorLog(req, ex)
         except Exception as ex:
             resp.status = falcon.HTTP_500
             reqErrorLog(req, ex)
@@ -111,9 +235,15 @@ class Jobs:
         reqDebugLog(req)
         try:
             req_body = json.load(req.bounded_stream)
-            resp.body = self.__jobs_handler.create(req_body["model_id"])
+            priority = req_body.get("priority", 0)
+            if not isinstance(priority, int) or isinstance(priority, bool):
+                raise ValueError("priority must be an integer")
+            resp.body = self.__jobs_handler.create(model_id=req_body["model_id"], priority=priority)
             resp.content_type = falcon.MEDIA_TEXT
             resp.status = falcon.HTTP_200
+        except ValueError as ex:
+            resp.status = falcon.HTTP_400
+            reqErrorLog(req, ex)
         except Exception as ex:
             resp.status = falcon.HTTP_500
             reqErrorLog(req, ex)
@@ -154,3 +284,84 @@ class Job:
         except Exception as ex:
             resp.status = falcon.HTTP_500
             reqErrorLog(req, ex)
+
+    def on_delete(self, req: falcon.request.Request, resp: falcon.response.Response, job_id):
+        reqDebugLog(req)
+        try:
+            try:
+                self.__jobs_handler.abort(job_id)
+                resp.status = falcon.HTTP_202
+            except KeyError:
+                # finished jobs can't be aborted anymore
+                self.__db_handler.get(b"jobs-", job_id.encode())
+                resp.status = falcon.HTTP_409
+        except KeyError as ex:
+            resp.status = falcon.HTTP_404
+            reqErrorLog(req, ex)
+        except Exception as ex:
+            resp.status = falcon.HTTP_500
+            reqErrorLog(req, ex)
+
+
+class Leases:
+    def __init__(self, jobs_handler: handlers.Jobs):
+        self.__jobs_handler = jobs_handler
+
+    def on_post(self, req: falcon.request.Request, resp: falcon.response.Response):
+        reqDebugLog(req)
+        try:
+            req_body = json.load(req.bounded_stream)
+            lease = self.__jobs_handler.claim(worker=req_body["worker"])
+            if lease:
+                resp.content_type = falcon.MEDIA_JSON
+                resp.body = json.dumps(dict(lease))
+                resp.status = falcon.HTTP_200
+            else:
+                resp.status = falcon.HTTP_204
+        except Exception as ex:
+            resp.status = falcon.HTTP_500
+            reqErrorLog(req, ex)
+
+
+class Lease:
+    def __init__(self, jobs_handler: handlers.Jobs):
+        self.__jobs_handler = jobs_handler
+
+    def on_put(self, req: falcon.request.Request, resp: falcon.response.Response, lease_id):
+        reqDebugLog(req)
+        try:
+            self.__jobs_handler.renew(lease_id)
+            resp.status = falcon.HTTP_200
+        except KeyError as ex:
+            resp.status = falcon.HTTP_404
+            reqErrorLog(req, ex)
+        except Exception as ex:
+            resp.status = falcon.HTTP_500
+            reqErrorLog(req, ex)
+
+    def on_post(self, req: falcon.request.Request, resp: falcon.response.Response, lease_id):
+        reqDebugLog(req)
+        try:
+            self.__jobs_handler.complete(lease_id, models.JobResult(json.load(req.bounded_stream)))
+            resp.status = falcon.HTTP_200
+        except KeyError as ex:
+            resp.status = falcon.HTTP_404
+            reqErrorLog(req, ex)
+        except ValueError as ex:
+            resp.status = falcon.HTTP_400
+            reqErrorLog(req, ex)
+        except Exception as ex:
+            resp.status = falcon.HTTP_500
+            reqErrorLog(req, ex)
+
+    def on_delete(self, req: falcon.request.Request, resp: falcon.response.Response, lease_id):
+        reqDebugLog(req)
+        try:
+            self.__jobs_handler.release(lease_id)
+            resp.status = falcon.HTTP_200
+        except KeyError as ex:
+            resp.status = falcon.HTTP_404
+            reqErrorLog(req, ex)
+        except Exception as ex:
+            resp.status = falcon.HTTP_500
+            reqErrorLog(req, ex)
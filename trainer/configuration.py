@@ -31,18 +31,53 @@ class Conf:
     class Storage:
         db_path = "/db"
         data_cache_path = "/data_cache"
+        models_path = "/models"
+
+    @simple_env_var.section
+    class Models:
+        format = "pickle"
+        codec = "gzip"
+        level = 0
 
     @simple_env_var.section
     class Data:
         api_url = "http://test"
-        max_age = 1800
+        max_downloads = 4
+        max_prefetches = 2
+        cache_streams = True
+        cache_frames = True
+        cache_size = 10240
 
     @simple_env_var.section
     class Jobs:
         max_num = 5
+        max_memory = 0
+        max_cpus = 0
+        cpu_affinity = True
+        job_timeout = 0
+        job_max_memory = 0
+        lease_time = 60
+        memory_factor = 4
         check = 5
         skd_delay = 21600
         skd_enabled = True
+        skd_max_requests = 4
+        skd_budget = 0
+        skd_priority = -1
+        skd_min_growth = 0
+        compact_data = False
+        cache_features = True
+        incremental_features = False
+        grid_threads = 2
+        worker_max_jobs = 10
+        worker_max_memory = 2048
+
+    @simple_env_var.section
+    class Node:
+        trainer_url = "http://trainer"
+        name = ""
+        max_num = 2
+        poll = 5
 
 
 conf = Conf(load=False)
@@ -15,7 +15,9 @@
 """
 
 from .db import *
+from .storage import *
 from . import configs
 from .data import *
 from .jobs import *
+from .node import *
 from .scheduler import *
@@ -20,140 +20,1106 @@ __all__ = ("Data", )
 from ..logger import getLogger
 from .. import util, models
 import requests
+import requests.adapters
 import os
 import time
 import typing
 import threading
 import urllib.parse
-import uuid
 import hashlib
+import concurrent.futures
+import queue
+import json
+import fcntl
+import contextlib
+import collections
+import shutil
+import sys
+import simple_struct
+import pandas
+import numpy
 
 
 logger = getLogger(__name__.split(".", 1)[-1])
 
 
+@simple_struct.structure
 class CacheItem:
-    def __init__(self):
-        self.files = None
-        self.columns = None
-        self.default_values = None
-        self.checksum = None
-        self.created = time.time()
-        self.time_field = None
-        self.lock = threading.Lock()
+    source_id: str = None
+    checksum: str = None
+    files: list = None
+    chunks: list = None
+    sizes: list = None
+    columns: list = None
+    default_values: dict = None
+    time_field: str = None
+    etags: list = None
+    compressed: bool = None
+    frame_size: int = None
+    frame_kind: str = None
+    features: dict = None
+    created: float = None
+    last_used: float = None
+
+
+class StaleChunksError(RuntimeError):
+    pass
+
+
+class Chunk:
+    def __init__(self, hash: typing.Optional[str] = None, size: int = 0, etag: typing.Optional[str] = None, path: typing.Optional[str] = None, file: typing.Optional[typing.BinaryIO] = None):
+        self.hash = hash
+        self.size = size
+        self.etag = etag
+        self.path = path
+        self.file = file
+
+    def discard(self):
+        if self.file:
+            self.file.close()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class DownloadLock:
+    def __init__(self, path: str):
+        self.__path = path
+        self.__lock = threading.Lock()
+        self.__file = None
+
+    @staticmethod
+    def is_current(file: typing.IO, path: str) -> bool:
+        # lock files removed while waiting for the lock are replaced by new ones
+        try:
+            return os.fstat(file.fileno()).st_ino == os.stat(path).st_ino
+        except FileNotFoundError:
+            return False
+
+    def acquire(self):
+        # the file lock serializes processes, the thread lock serializes threads of this process
+        self.__lock.acquire()
+        try:
+            while True:
+                self.__file = open(self.__path, "a")
+                fcntl.flock(self.__file, fcntl.LOCK_EX)
+                if self.is_current(self.__file, self.__path):
+                    break
+                self.__file.close()
+                self.__file = None
+        except Exception as ex:
+            if self.__file:
+                self.__file.close()
+                self.__file = None
+            self.__lock.release()
+            raise ex
+
+    def release(self):
+        fcntl.flock(self.__file, fcntl.LOCK_UN)
+        self.__file.close()
+        self.__file = None
+        self.__lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class Cache:
+    def __init__(self, st_path: str, max_size: int):
+        self.__chunks_path = os.path.join(st_path, "chunks")
+        self.__frames_path = os.path.join(st_path, "frames")
+        self.__features_path = os.path.join(st_path, "features")
+        self.__index_path = os.path.join(st_path, "index.json")
+        self.__lock_path = os.path.join(st_path, "index.lock")
+        self.__max_size = max_size
+        self.__lock = threading.Lock()
+        os.makedirs(self.__chunks_path, exist_ok=True)
+        os.makedirs(self.__frames_path, exist_ok=True)
+        os.makedirs(self.__features_path, exist_ok=True)
+        os.register_at_fork(after_in_child=self.__reset_lock)
+
+    def __reset_lock(self):
+        self.__lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def __index(self, write: bool = True) -> typing.Generator[typing.Dict[str, CacheItem], None, None]:
+        # the index is shared with worker processes
+        with self.__lock:
+            with open(self.__lock_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    index = self.__load()
+                    yield index
+                    if write:
+                        self.__store(index)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def __load(self) -> typing.Dict[str, CacheItem]:
+        try:
+            with open(self.__index_path, "r") as file:
+                return {key: CacheItem(value) for key, value in json.load(file).items()}
+        except FileNotFoundError:
+            return dict()
+        except Exception as ex:
+            logger.error("could not load cache index - {}".format(ex))
+            return dict()
+
+    def __store(self, index: typing.Dict[str, CacheItem]):
+        tmp_path = "{}.{}".format(self.__index_path, os.getpid())
+        with open(tmp_path, "w") as file:
+            json.dump({key: dict(item) for key, item in index.items()}, file)
+        os.replace(tmp_path, self.__index_path)
+
+    def __get_chunk_path(self, chunk: str) -> str:
+        return os.path.join(self.__chunks_path, chunk)
+
+    def __remove_chunk(self, chunk: str):
+        try:
+            os.remove(self.__get_chunk_path(chunk))
+        except Exception as ex:
+            logger.warning("could not remove cached chunk '{}' - {}".format(chunk, ex))
+
+    def __get_frame_path(self, checksum: str) -> str:
+        return os.path.join(self.__frames_path, checksum)
+
+    def __remove_frame(self, checksum: str):
+        shutil.rmtree(self.__get_frame_path(checksum), ignore_errors=True)
+
+    def __get_features_path(self, checksum: str, key: str) -> str:
+        return os.path.join(self.__features_path, "{}-{}".format(checksum, key))
+
+    def __remove_features(self, checksum: str, key: str):
+        shutil.rmtree(self.__get_features_path(checksum, key), ignore_errors=True)
+
+    def __remove_derived(self, item: CacheItem) -> int:
+        size = 0
+        if item.frame_size:
+            self.__remove_frame(item.checksum)
+            size += item.frame_size
+        for key, features_size in (item.features or dict()).items():
+            self.__remove_features(item.checksum, key)
+            size += features_size
+        return size
+
+    @staticmethod
+    def __get_dir_size(path: str) -> int:
+        return sum(os.path.getsize(os.path.join(path, file)) for file in os.listdir(path))
+
+    def __evict(self, index: typing.Dict[str, CacheItem], keep: typing.Optional[str] = None):
+        references = collections.Counter(chunk for item in index.values() for chunk in set(item.chunks))
+        sizes = {chunk: size for item in index.values() for chunk, size in zip(item.chunks, item.sizes)}
+        total = sum(sizes.values()) + sum((item.frame_size or 0) + sum((item.features or dict()).values()) for item in index.values())
+        for key in sorted(index.keys(), key=lambda k: index[k].last_used):
+            if total <= self.__max_size:
+                break
+            if key == keep:
+                continue
+            item = index.pop(key)
+            for chunk in set(item.chunks):
+                references[chunk] -= 1
+                if not references[chunk]:
+                    self.__remove_chunk(chunk)
+                    total -= sizes[chunk]
+            total -= self.__remove_derived(item)
+            logger.debug("evicted data of '{}' with checksum '{}' from cache".format(item.source_id, item.checksum))
+        if total > self.__max_size:
+            logger.warning("cache exceeds size limit by {} bytes".format(total - self.__max_size))
+
+    def open(self, checksum: str) -> typing.Optional[typing.Tuple[CacheItem, typing.List[typing.BinaryIO]]]:
+        with self.__index() as index:
+            item = index.get(checksum)
+            if not item:
+                return None
+            files = list()
+            try:
+                for chunk in item.chunks:
+                    files.append(open(self.__get_chunk_path(chunk), "rb"))
+            except FileNotFoundError as ex:
+                logger.warning("removing incomplete data of '{}' from cache - {}".format(item.source_id, ex))
+                for file in files:
+                    file.close()
+                del index[checksum]
+                return None
+            item.last_used = time.time()
+            return item, files
+
+    def find(self, source_id: str) -> typing.Optional[CacheItem]:
+        with self.__index(write=False) as index:
+            items = [item for item in index.values() if item.source_id == source_id]
+            if items:
+                return max(items, key=lambda item: item.created)
+
+    def open_chunks(self, chunks: typing.List[str]) -> typing.List[typing.Optional[typing.BinaryIO]]:
+        files = list()
+        with self.__index(write=False):
+            for chunk in chunks:
+                try:
+                    files.append(open(self.__get_chunk_path(chunk), "rb"))
+                except FileNotFoundError:
+                    files.append(None)
+        return files
+
+    def remove(self, checksum: str):
+        with self.__index() as index:
+            item = index.pop(checksum, None)
+            if not item:
+                return
+            references = set(chunk for other in index.values() for chunk in other.chunks)
+            for chunk in set(item.chunks) - references:
+                self.__remove_chunk(chunk)
+            self.__remove_derived(item)
+            logger.debug("removed data of '{}' with checksum '{}' from cache".format(item.source_id, item.checksum))
+
+    def get(self, checksum: str) -> typing.Optional[CacheItem]:
+        opened = self.open(checksum)
+        if opened:
+            for file in opened[1]:
+                file.close()
+            return opened[0]
+
+    def add(self, item: CacheItem, parts: typing.Dict[str, str]):
+        with self.__index() as index:
+            for chunk in item.chunks:
+                if chunk not in parts and not os.path.exists(self.__get_chunk_path(chunk)):
+                    raise RuntimeError("missing chunk '{}'".format(chunk))
+            for chunk, path in parts.items():
+                if os.path.exists(self.__get_chunk_path(chunk)):
+                    os.remove(path)
+                else:
+                    os.replace(path, self.__get_chunk_path(chunk))
+            item.created = item.last_used = time.time()
+            index[item.checksum] = item
+            self.__evict(index, keep=item.checksum)
+
+    def load_frame(self, checksum: str, kind: typing.Optional[str] = None) -> typing.Optional[pandas.DataFrame]:
+        with self.__index() as index:
+            item = index.get(checksum)
+            if not item or not item.frame_size or item.frame_kind != kind:
+                return None
+            try:
+                df = util.read_frame(self.__get_frame_path(checksum))
+            except Exception as ex:
+                logger.warning("removing invalid frame of '{}' from cache - {}".format(item.source_id, ex))
+                self.__remove_frame(checksum)
+                item.frame_size = None
+                return None
+            item.last_used = time.time()
+            return df
+
+    def add_frame(self, checksum: str, path: str, kind: typing.Optional[str] = None) -> bool:
+        with self.__index() as index:
+            item = index.get(checksum)
+            if not item or (item.frame_size and item.frame_kind == kind):
+                shutil.rmtree(path, ignore_errors=True)
+                return False
+            # only one frame is kept per data set, frames of another kind are replaced
+            self.__remove_frame(checksum)
+            item.frame_kind = kind
+            os.replace(path, self.__get_frame_path(checksum))
+            item.frame_size = self.__get_dir_size(self.__get_frame_path(checksum))
+            self.__evict(index, keep=checksum)
+            return True
+
+    def load_features(self, checksum: str, key: str) -> typing.Optional[pandas.DataFrame]:
+        with self.__index() as index:
+            item = index.get(checksum)
+            if not item or key not in (item.features or dict()):
+                return None
+            try:
+                df = util.read_frame(self.__get_features_path(checksum, key))
+            except Exception as ex:
+                logger.warning("removing invalid features of '{}' from cache - {}".format(item.source_id, ex))
+                self.__remove_features(checksum, key)
+                del item.features[key]
+                return None
+            item.last_used = time.time()
+            return df
+
+    def find_features(self, checksum: str, key: str) -> typing.Optional[pandas.DataFrame]:
+        # features of the data set or, if not available, of the most recent previous data set of the same source
+        with self.__index() as index:
+            item = index.get(checksum)
+            if not item:
+                return None
+            items = [other for other in index.values() if other.source_id == item.source_id and key in (other.features or dict())]
+            for other in sorted(items, key=lambda other: (other.checksum == checksum, other.created), reverse=True):
+                try:
+                    df = util.read_frame(self.__get_features_path(other.checksum, key))
+                except Exception as ex:
+                    logger.warning("removing invalid features of '{}' from cache - {}".format(other.source_id, ex))
+                    self.__remove_features(other.checksum, key)
+                    del other.features[key]
+                    continue
+                other.last_used = time.time()
+                return df
+
+    def add_features(self, checksum: str, key: str, path: str) -> bool:
+        with self.__index() as index:
+            item = index.get(checksum)
+            if not item or key in (item.features or dict()):
+                shutil.rmtree(path, ignore_errors=True)
+                return False
+            self.__remove_features(checksum, key)
+            os.replace(path, self.__get_features_path(checksum, key))
+            item.features = dict(item.features or dict(), **{key: self.__get_dir_size(self.__get_features_path(checksum, key))})
+            self.__evict(index, keep=checksum)
+            return True
+
+    def clean(self):
+        with self.__index() as index:
+            for key in list(index.keys()):
+                for chunk, size in zip(index[key].chunks, index[key].sizes):
+                    try:
+                        if os.stat(self.__get_chunk_path(chunk)).st_size == size:
+                            continue
+                    except FileNotFoundError:
+                        pass
+                    logger.warning("removing invalid data of '{}' from cache".format(index[key].source_id))
+                    del index[key]
+                    break
+            for item in index.values():
+                if item.frame_size and not os.path.isfile(os.path.join(self.__get_frame_path(item.checksum), "frame.json")):
+                    item.frame_size = None
+                for key in list((item.features or dict()).keys()):
+                    if not os.path.isfile(os.path.join(self.__get_features_path(item.checksum, key), "frame.json")):
+                        del item.features[key]
+            chunks = set(chunk for item in index.values() for chunk in item.chunks)
+            for chunk in os.listdir(self.__chunks_path):
+                if chunk not in chunks:
+                    self.__remove_chunk(chunk)
+            for checksum in os.listdir(self.__frames_path):
+                if checksum not in index or not index[checksum].frame_size:
+                    self.__remove_frame(checksum)
+            for name in os.listdir(self.__features_path):
+                checksum, _, key = name.partition("-")
+                if checksum not in index or key not in (index[checksum].features or dict()):
+                    self.__remove_features(checksum, key)
+            self.__evict(index)
+
+
+class DataStream:
+    __poll_timeout = 1
+
+    def __init__(self, path: str, columns: list, default_values: dict, time_field: str, checksum: str):
+        self.path = path
+        self.columns = columns
+        self.default_values = default_values
+        self.time_field = time_field
+        self.checksum = checksum
+        self.__threads: typing.List[threading.Thread] = list()
+        self.__error: typing.Optional[Exception] = None
+        self.__aborted = threading.Event()
+        os.mkfifo(path)
+
+    def start(self, name: str, target: typing.Callable, *args):
+        thread = threading.Thread(name=name, target=target, args=args, daemon=True)
+        self.__threads.append(thread)
+        thread.start()
+
+    @property
+    def aborted(self) -> bool:
+        return self.__aborted.is_set()
+
+    def abort(self, ex: typing.Optional[Exception] = None):
+        # errors raised after aborting are consequences of the abort
+        if ex and not self.__error and not self.__aborted.is_set():
+            self.__error = ex
+        self.__aborted.set()
+        self.__unblock()
+
+    def put(self, buffers: queue.Queue, item):
+        while not self.__aborted.is_set():
+            try:
+                buffers.put(item, timeout=self.__poll_timeout)
+                return
+            except queue.Full:
+                pass
+        raise RuntimeError("stream aborted")
+
+    def get(self, buffers: queue.Queue):
+        while not self.__aborted.is_set():
+            try:
+                return buffers.get(timeout=self.__poll_timeout)
+            except queue.Empty:
+                pass
+        raise RuntimeError("stream aborted")
+
+    def __unblock(self):
+        # releases a writer waiting for a reader to open the fifo
+        try:
+            os.close(os.open(self.path, os.O_RDONLY | os.O_NONBLOCK))
+        except Exception:
+            pass
+
+    def close(self, raise_error: bool = True):
+        for thread in self.__threads:
+            thread.join(self.__poll_timeout)
+            while thread.is_alive():
+                self.__unblock()
+                thread.join(self.__poll_timeout)
+        self.__threads.clear()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        if self.__error and raise_error:
+            raise self.__error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            # errors of the stream take precedence, they are likely the cause of the consumer failing
+            error = self.__error
+            self.abort()
+            self.close(raise_error=False)
+            if error:
+                raise error from exc_val
+        else:
+            self.close()
 
 
 class Data(threading.Thread):
     __chunk_size = 65536
+    __max_retries = 5
+    __backoff = 0.5
+    __max_backoff = 30
+    __timeout = 60
+    __stream_buffers = 64
+    __clean_interval = 900
+    __compression_ratio = 5
+    __window_column = "window_hash"
 
-    def __init__(self, st_path: str, data_api_url: str, max_age: int):
+    def __init__(self, st_path: str, data_api_url: str, max_downloads: int, max_prefetches: int, cache_streams: bool, cache_frames: bool, cache_size: int):
         super().__init__(name="data-handler", daemon=True)
         self.__st_path = st_path
+        self.__tmp_path = os.path.join(st_path, "tmp")
+        self.__locks_path = os.path.join(st_path, "locks")
         self.__data_api_url = data_api_url
-        self.__max_age = max_age
-        self.__cache: typing.Dict[str, CacheItem] = dict()
+        self.__max_downloads = max_downloads
+        self.__max_prefetches = max_prefetches
+        self.__cache_streams = cache_streams
+        self.__cache_frames = cache_frames
+        self.__cache = Cache(st_path=st_path, max_size=cache_size * 1048576)
+        self.__lock = threading.Lock()
+        self.__download_locks: typing.Dict[str, DownloadLock] = dict()
+        self.__session: typing.Optional[requests.Session] = None
+        self.__session_pid = None
+        self.__prefetch_executor: typing.Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self.__prefetching = set()
+        self.__metadata: typing.Dict[str, typing.Tuple[str, dict]] = dict()
+        os.makedirs(self.__tmp_path, exist_ok=True)
+        os.makedirs(self.__locks_path, exist_ok=True)
+        os.register_at_fork(after_in_child=self.__reset_locks)
+
+    def __reset_locks(self):
+        # locks held by other threads at fork time would never be released in the child
         self.__lock = threading.Lock()
+        self.__download_locks = dict()
+        self.__prefetch_executor = None
+        self.__prefetching = set()
+
+    def __get_session(self) -> requests.Session:
+        # connections must not be shared with forked processes
+        with self.__lock:
+            if self.__session_pid != os.getpid():
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, self.__max_downloads) * max(1, self.__max_prefetches + 1))
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.__session = session
+                self.__session_pid = os.getpid()
+            return self.__session
 
     def get_metadata(self, source_id: str) -> models.MetaData:
-        resp = requests.get(url="{}/{}".format(self.__data_api_url, urllib.parse.quote(source_id)))
+        # unchanged metadata is not transferred again if the API supports conditional requests
+        with self.__lock:
+            cached = self.__metadata.get(source_id)
+        resp = self.__get_session().get(
+            url="{}/{}".format(self.__data_api_url, urllib.parse.quote(source_id)),
+            headers={"If-None-Match": cached[0]} if cached else None,
+            timeout=self.__timeout
+        )
+        if resp.status_code == 304 and cached:
+            return models.MetaData(cached[1])
         if not resp.ok:
             raise RuntimeError(resp.status_code)
         metadata = models.MetaData(resp.json())
         if not metadata.checksum:
             raise RuntimeError("no data available for '{}'".format(source_id))
+        if resp.headers.get("ETag"):
+            with self.__lock:
+                self.__metadata[source_id] = (resp.headers["ETag"], dict(metadata))
         return metadata
 
-    def __get_chunk(self, source_id: str, file: str, checksum: hashlib.sha256, compressed: bool):
-        with requests.get(url="{}/{}/files/{}".format(self.__data_api_url, urllib.parse.quote(source_id), file),
-                          stream=True) as resp:
-            if not resp.ok:
-                raise RuntimeError(resp.status_code)
-            with open(os.path.join(self.__st_path, file), "wb") as file:
-                if compressed:
-                    file = util.Decompress(file)
-                buffer = resp.raw.read(self.__chunk_size)
-                checksum.update(buffer)
-                while buffer:
-                    file.write(buffer)
-                    buffer = resp.raw.read(self.__chunk_size)
-                    checksum.update(buffer)
-                file.flush()
-
-    def __get_data(self, source_id: str, files: list, compressed: bool):
-        checksum = hashlib.sha256()
+    def __iter_chunk(self, source_id: str, file: str, chunk: Chunk) -> typing.Generator[bytes, None, None]:
+        url = "{}/{}/files/{}".format(self.__data_api_url, urllib.parse.quote(source_id), file)
+        received = 0
         retries = 0
-        chunk_count = 0
-        for file in files:
-            chunk_count += 1
-            logger.debug("retrieving chunk {}/{} for '{}' ...".format(chunk_count, len(files), source_id))
+        while True:
+            resumed_at = received
             try:
-                self.__get_chunk(source_id=source_id, file=file, checksum=checksum, compressed=compressed)
+                with self.__get_session().get(
+                        url=url,
+                        headers={"Range": "bytes={}-".format(received)} if received else None,
+                        stream=True,
+                        timeout=self.__timeout
+                ) as resp:
+                    if not resp.ok:
+                        raise RuntimeError(resp.status_code)
+                    chunk.etag = resp.headers.get("ETag")
+                    offset = 0
+                    if resp.status_code == 206:
+                        offset = int(resp.headers["Content-Range"].split(" ")[-1].split("-")[0])
+                        if offset > received:
+                            raise RuntimeError("unexpected range '{}'".format(resp.headers["Content-Range"]))
+                    length = resp.headers.get("Content-Length")
+                    end = offset + int(length) if length is not None else None
+                    buffer = resp.raw.read(self.__chunk_size)
+                    while buffer:
+                        if offset < received:
+                            skip = min(received - offset, len(buffer))
+                            offset += skip
+                            buffer = buffer[skip:]
+                        if buffer:
+                            offset += len(buffer)
+                            received = offset
+                            yield buffer
+                        buffer = resp.raw.read(self.__chunk_size)
+                    if end is not None and offset != end:
+                        raise RuntimeError("incomplete response")
+                return
             except Exception as ex:
-                if retries >= 5:
-                    logger.error("retrieving chunk {}/{} for '{}' failed - {}".format(chunk_count, len(files), source_id, ex))
+                if received > resumed_at:
+                    retries = 0
+                if retries >= self.__max_retries:
                     raise ex
+                delay = min(self.__backoff * 2 ** retries, self.__max_backoff)
+                retries += 1
+                logger.warning(
+                    "retrieving '{}' for '{}' failed - {} - resuming at byte {} in {}s".format(file, source_id, ex, received, delay)
+                )
+                time.sleep(delay)
+
+    def __get_chunk(self, source_id: str, file: str) -> Chunk:
+        chunk = Chunk(path=self.__get_tmp_path("part"))
+        chunk_hash = hashlib.sha256()
+        try:
+            with open(chunk.path, "wb") as part:
+                for buffer in self.__iter_chunk(source_id=source_id, file=file, chunk=chunk):
+                    chunk_hash.update(buffer)
+                    part.write(buffer)
+                    chunk.size += len(buffer)
+        except Exception as ex:
+            chunk.discard()
+            raise ex
+        chunk.hash = chunk_hash.hexdigest()
+        return chunk
+
+    def __retrieve_chunk(self, source_id: str, files: list, pos: int) -> Chunk:
+        logger.debug("retrieving chunk {}/{} for '{}' ...".format(pos + 1, len(files), source_id))
+        try:
+            return self.__get_chunk(source_id=source_id, file=files[pos])
+        except Exception as ex:
+            logger.error("retrieving chunk {}/{} for '{}' failed - {}".format(pos + 1, len(files), source_id, ex))
+            raise ex
+
+    def __iter_chunks(self, source_id: str, files: list, reusable: typing.Dict[int, Chunk]) -> typing.Generator[Chunk, None, None]:
+        # chunks are retrieved concurrently and yielded in file order, at most max_downloads chunks are retrieved ahead
+        max_workers = max(1, min(self.__max_downloads, len(files)))
+        futures: typing.Dict[int, concurrent.futures.Future] = dict()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="data-download") as executor:
+            try:
+                next_pos = 0
+                for pos in range(len(files)):
+                    while next_pos < len(files) and len(futures) < max_workers:
+                        if next_pos not in reusable:
+                            futures[next_pos] = executor.submit(self.__retrieve_chunk, source_id, files, next_pos)
+                        next_pos += 1
+                    if pos in reusable:
+                        logger.debug("reusing chunk {}/{} for '{}'".format(pos + 1, len(files), source_id))
+                        yield reusable.pop(pos)
+                    else:
+                        yield futures.pop(pos).result()
+            finally:
+                # chunks that were not yielded are discarded if the consumer stops or retrieving fails
+                for future in futures.values():
+                    future.cancel()
+                concurrent.futures.wait(futures.values())
+                for future in futures.values():
+                    if not future.cancelled() and not future.exception():
+                        future.result().discard()
+                for chunk in reusable.values():
+                    chunk.discard()
+                reusable.clear()
+
+    def __read_chunk(self, chunk: Chunk, consume: typing.Callable[[bytes], None]):
+        # reused chunks are read from the opened cache file, retrieved chunks from their part file
+        file = chunk.file or open(chunk.path, "rb")
+        try:
+            buffer = file.read(self.__chunk_size)
+            while buffer:
+                consume(buffer)
+                buffer = file.read(self.__chunk_size)
+        finally:
+            file.close()
+            chunk.file = None
+
+    def __get_chunk_info(self, source_id: str, file: str) -> typing.Tuple[typing.Optional[int], typing.Optional[str]]:
+        try:
+            resp = self.__get_session().head(
+                url="{}/{}/files/{}".format(self.__data_api_url, urllib.parse.quote(source_id), file),
+                timeout=self.__timeout
+            )
+            if resp.ok and resp.headers.get("Content-Length") is not None:
+                return int(resp.headers["Content-Length"]), resp.headers.get("ETag")
+        except Exception as ex:
+            logger.debug("could not retrieve info for '{}' of '{}' - {}".format(file, source_id, ex))
+        return None, None
+
+    def __get_reusable_chunks(self, source_id: str, metadata: models.MetaData) -> typing.Tuple[typing.Optional[CacheItem], typing.Dict[int, Chunk]]:
+        # chunks are considered unchanged if name, size and, if provided, etag match the previous data
+        previous = self.__cache.find(source_id)
+        if not previous:
+            return None, dict()
+        known = {
+            file: Chunk(hash=chunk, size=size, etag=etag)
+            for file, chunk, size, etag in zip(previous.files, previous.chunks, previous.sizes, previous.etags or [None] * len(previous.files))
+        }
+        candidates = [pos for pos in range(len(metadata.files)) if metadata.files[pos] in known]
+        if not candidates:
+            return previous, dict()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, min(self.__max_downloads, len(candidates))),
+                thread_name_prefix="data-info"
+        ) as executor:
+            infos = list(executor.map(lambda pos: self.__get_chunk_info(source_id, metadata.files[pos]), candidates))
+        unchanged = list()
+        for pos, (size, etag) in zip(candidates, infos):
+            chunk = known[metadata.files[pos]]
+            if size == chunk.size and (not etag or not chunk.etag or etag == chunk.etag):
+                unchanged.append(pos)
+        files = self.__cache.open_chunks([known[metadata.files[pos]].hash for pos in unchanged])
+        reusable = dict()
+        for pos, file in zip(unchanged, files):
+            if file:
+                chunk = known[metadata.files[pos]]
+                reusable[pos] = Chunk(hash=chunk.hash, size=chunk.size, etag=chunk.etag, file=file)
+        logger.debug("{}/{} chunks of '{}' unchanged".format(len(reusable), len(metadata.files), source_id))
+        return previous, reusable
+
+    def __get_data(self, source_id: str, files: list, reusable: typing.Dict[int, Chunk]) -> typing.Tuple[str, typing.List[Chunk]]:
+        checksum = hashlib.sha256()
+        chunks = list()
+        try:
+            with contextlib.closing(self.__iter_chunks(source_id, files, reusable)) as iterator:
+                for chunk in iterator:
+                    chunks.append(chunk)
+                    self.__read_chunk(chunk, checksum.update)
+        except Exception as ex:
+            for chunk in chunks:
+                chunk.discard()
+            raise ex
+        return checksum.hexdigest(), chunks
+
+    def __get_new(self, source_id: str, metadata: models.MetaData) -> CacheItem:
+        previous, reusable = self.__get_reusable_chunks(source_id, metadata)
+        reused = len(reusable)
+        checksum, chunks = self.__get_data(source_id, metadata.files, reusable)
+        try:
+            if reused and metadata.checksum != checksum:
+                logger.warning("checksum mismatch for '{}' - retrieving all chunks".format(source_id))
+                self.__cache.remove(previous.checksum)
+                for chunk in chunks:
+                    chunk.discard()
+                checksum, chunks = self.__get_data(source_id, metadata.files, dict())
+            retries = 0
+            while metadata.checksum != checksum:
+                if retries > 3:
+                    raise RuntimeError("checksum mismatch for '{}' - data might have changed".format(source_id))
+                logger.warning("checksum mismatch for '{}' - refreshing metadata".format(source_id))
+                metadata = self.get_metadata(source_id)
                 retries += 1
-        return checksum.hexdigest()
+            cache_item = self.__new_cache_item(source_id, metadata, chunks)
+            self.__cache.add(cache_item, {chunk.hash: chunk.path for chunk in chunks if chunk.path})
+            return cache_item
+        except Exception as ex:
+            for chunk in chunks:
+                chunk.discard()
+            raise ex
 
-    def __get_new(self, source_id: str):
+    @staticmethod
+    def __new_cache_item(source_id: str, metadata: models.MetaData, chunks: typing.List[Chunk]) -> CacheItem:
+        return CacheItem(
+            source_id=source_id,
+            checksum=metadata.checksum,
+            files=metadata.files,
+            chunks=[chunk.hash for chunk in chunks],
+            sizes=[chunk.size for chunk in chunks],
+            etags=[chunk.etag for chunk in chunks],
+            columns=metadata.columns,
+            default_values=metadata.default_values,
+            time_field=metadata.time_field,
+            compressed=metadata.compressed
+        )
+
+    def __get_lock(self, name: str) -> DownloadLock:
+        with self.__lock:
+            if name not in self.__download_locks:
+                self.__download_locks[name] = DownloadLock(os.path.join(self.__locks_path, name))
+            return self.__download_locks[name]
+
+    def __get_download_lock(self, checksum: str) -> DownloadLock:
+        # lock files are keyed by checksum so unrelated sources never wait on each other, unused ones are removed on startup
+        return self.__get_lock(checksum)
+
+    def __get_frame_lock(self, checksum: str) -> DownloadLock:
+        return self.__get_lock("frame-{}".format(checksum))
+
+    def get(self, source_id: str) -> CacheItem:
         metadata = self.get_metadata(source_id)
-        checksum = self.__get_data(source_id, metadata.files, metadata.compressed)
-        retries = 0
-        while metadata.checksum != checksum:
-            if retries > 3:
-                raise RuntimeError("checksum mismatch for '{}' - data might have changed")
-            logger.warning("checksum mismatch for '{}' - refreshing metadata".format(source_id))
-            metadata = self.get_metadata(source_id)
-            retries += 1
-        return metadata.files, metadata.columns, metadata.default_values, metadata.checksum, metadata.time_field
-
-    def __refresh_cache_item(self, source_id: str, cache_item: CacheItem):
-        cache_item.files, cache_item.columns, cache_item.default_values, cache_item.checksum, cache_item.time_field = self.__get_new(source_id=source_id)
-
-    def get(self, source_id: str) -> typing.Tuple[list, list, dict, str]:
+        with self.__get_download_lock(metadata.checksum):
+            cache_item = self.__cache.get(metadata.checksum)
+            if not cache_item:
+                cache_item = self.__get_new(source_id, metadata)
+            return cache_item
+
+    def estimate_size(self, source_id: str) -> typing.Optional[int]:
+        # in-memory size of the parsed data, based on the most recent data of the source
+        cache_item = self.__cache.find(source_id)
+        if not cache_item:
+            return None
+        if cache_item.frame_size:
+            return cache_item.frame_size
+        return sum(cache_item.sizes) * (self.__compression_ratio if cache_item.compressed else 1)
+
+    def get_size(self, source_id: str, metadata: models.MetaData) -> typing.Optional[int]:
+        # size of the stored data, files of other data than the cached one might have changed and are requested
+        cache_item = self.__cache.find(source_id)
+        if cache_item and cache_item.checksum == metadata.checksum:
+            return sum(cache_item.sizes)
+        if not metadata.files:
+            return 0
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, min(self.__max_downloads, len(metadata.files))),
+                thread_name_prefix="data-info"
+        ) as executor:
+            sizes = [size for size, _ in executor.map(lambda file: self.__get_chunk_info(source_id, file), metadata.files)]
+        if None in sizes:
+            return None
+        return sum(sizes)
+
+    def prefetch(self, source_id: str):
+        if self.__max_prefetches < 1:
+            return
         with self.__lock:
-            if source_id not in self.__cache:
-                self.__cache[source_id] = CacheItem()
-        cache_item = self.__cache[source_id]
-        with cache_item.lock:
-            if not cache_item.files:
-                self.__refresh_cache_item(source_id, cache_item)
-            elif time.time() - cache_item.created > self.__max_age:
-                metadata = self.get_metadata(source_id)
-                if metadata.checksum != cache_item.checksum:
-                    old_files = cache_item.files
-                    self.__refresh_cache_item(source_id, cache_item)
-                    for old_file in old_files:
-                        try:
-                            os.remove(os.path.join(self.__st_path, old_file))
-                        except Exception as ex:
-                            logger.warning("could not remove stale data - {}".format(ex))
-                cache_item.created = time.time()
-            return [os.path.join(self.__st_path, file) for file in cache_item.files], cache_item.columns, cache_item.default_values, cache_item.time_field
+            if source_id in self.__prefetching:
+                return
+            if not self.__prefetch_executor:
+                self.__prefetch_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.__max_prefetches,
+                    thread_name_prefix="data-prefetch"
+                )
+            self.__prefetching.add(source_id)
+            self.__prefetch_executor.submit(self.__prefetch, source_id)
+
+    def __prefetch(self, source_id: str):
+        try:
+            logger.debug("prefetching data for '{}' ...".format(source_id))
+            self.get(source_id)
+        except Exception as ex:
+            logger.warning("prefetching data for '{}' failed - {}".format(source_id, ex))
+        finally:
+            with self.__lock:
+                self.__prefetching.discard(source_id)
+
+    def __download_stage(self, source_id: str, metadata: models.MetaData, stream: DataStream, buffers: queue.Queue, lock: typing.Optional[DownloadLock], reuse: bool):
+        chunks = list()
+        reusable = dict()
+        try:
+            previous, reusable = self.__get_reusable_chunks(source_id, metadata) if reuse else (None, dict())
+            reused = len(reusable)
+            checksum = hashlib.sha256()
+
+            def consume(buffer: bytes):
+                checksum.update(buffer)
+                stream.put(buffers, buffer)
+
+            with contextlib.closing(self.__iter_chunks(source_id, metadata.files, reusable)) as iterator:
+                for chunk in iterator:
+                    chunks.append(chunk)
+                    self.__read_chunk(chunk, consume)
+                    stream.put(buffers, b"")
+                    if not lock:
+                        # part files are only kept if streams are cached
+                        chunk.discard()
+            if checksum.hexdigest() != metadata.checksum:
+                if reused:
+                    # unchanged chunks might have been detected falsely, the consumer can retry without reusing chunks
+                    self.__cache.remove(previous.checksum)
+                    raise StaleChunksError("checksum mismatch for '{}' - reused chunks might have changed".format(source_id))
+                raise RuntimeError("checksum mismatch for '{}' - data might have changed".format(source_id))
+            stream.put(buffers, None)
+        except Exception as ex:
+            if not stream.aborted:
+                logger.error("streaming data for '{}' failed - {}".format(source_id, ex))
+            stream.abort(ex)
+            for chunk in chunks + list(reusable.values()):
+                chunk.discard()
+        else:
+            # the data was streamed completely, failing to cache it must not fail the consumer
+            if lock:
+                try:
+                    self.__cache.add(
+                        self.__new_cache_item(source_id, metadata, chunks),
+                        {chunk.hash: chunk.path for chunk in chunks if chunk.path}
+                    )
+                except Exception as ex:
+                    logger.warning("could not store data of '{}' in cache - {}".format(source_id, ex))
+                    for chunk in chunks:
+                        chunk.discard()
+        finally:
+            if lock:
+                lock.release()
+
+    def __write_stage(self, compressed: bool, stream: DataStream, buffers: queue.Queue):
+        try:
+            with open(stream.path, "wb") as fifo:
+                file_obj = None
+                while True:
+                    buffer = stream.get(buffers)
+                    if buffer is None:
+                        break
+                    if file_obj is None:
+                        file_obj = util.Decompress(fifo) if compressed else fifo
+                    if not buffer:
+                        file_obj.flush()
+                        file_obj = None
+                        continue
+                    file_obj.write(buffer)
+        except BrokenPipeError:
+            # consumer stopped reading
+            stream.abort()
+        except Exception as ex:
+            stream.abort(ex)
+
+    def __feed_stage(self, files: typing.List[typing.BinaryIO], compressed: bool, stream: DataStream):
+        try:
+            with open(stream.path, "wb") as fifo:
+                for file in files:
+                    if compressed:
+                        file_obj = util.Decompress(fifo)
+                        buffer = file.read(self.__chunk_size)
+                        while buffer:
+                            file_obj.write(buffer)
+                            buffer = file.read(self.__chunk_size)
+                        file_obj.flush()
+                    else:
+                        util.copy_file(file, fifo)
+        except BrokenPipeError:
+            stream.abort()
+        except Exception as ex:
+            stream.abort(ex)
+        finally:
+            for file in files:
+                file.close()
+
+    def __get_tmp_path(self, suffix: str) -> str:
+        return util.get_tmp_path(self.__tmp_path, suffix)
+
+    def remove_tmp_files(self, pid: int):
+        util.remove_tmp_files(self.__tmp_path, pid)
+
+    def __open_stream(self, source_id: str, metadata: models.MetaData, reuse: bool = True) -> DataStream:
+        lock = self.__get_download_lock(metadata.checksum)
+        lock.acquire()
+        locked = True
+        try:
+            opened = self.__cache.open(metadata.checksum)
+            if opened:
+                cache_item, files = opened
+                try:
+                    stream = DataStream(
+                        path=self.__get_tmp_path("fifo"),
+                        columns=cache_item.columns,
+                        default_values=cache_item.default_values,
+                        time_field=cache_item.time_field,
+                        checksum=cache_item.checksum
+                    )
+                except Exception as ex:
+                    for file in files:
+                        file.close()
+                    raise ex
+                stream.start("data-stream-feed", self.__feed_stage, files, cache_item.compressed, stream)
+            else:
+                stream = DataStream(
+                    path=self.__get_tmp_path("fifo"),
+                    columns=metadata.columns,
+                    default_values=metadata.default_values,
+                    time_field=metadata.time_field,
+                    checksum=metadata.checksum
+                )
+                buffers = queue.Queue(maxsize=self.__stream_buffers)
+                stream.start("data-stream-write", self.__write_stage, metadata.compressed, stream, buffers)
+                # if streams are cached the download stage releases the lock after storing the chunks
+                stream.start(
+                    "data-stream-download",
+                    self.__download_stage,
+                    source_id,
+                    metadata,
+                    stream,
+                    buffers,
+                    lock if self.__cache_streams else None,
+                    reuse
+                )
+                locked = not self.__cache_streams
+            return stream
+        finally:
+            if locked:
+                lock.release()
+
+    def __store_features(self, checksum: str, key: str, df: pandas.DataFrame):
+        path = self.__get_tmp_path("features")
+        try:
+            util.write_frame(df, path)
+            if self.__cache.add_features(checksum, key, path):
+                logger.debug("stored features '{}' in cache".format(key))
+        except Exception as ex:
+            logger.warning("could not store features '{}' in cache - {}".format(key, ex))
+            shutil.rmtree(path, ignore_errors=True)
+
+    @staticmethod
+    def __encode_param(obj):
+        # only values that are identical across processes and restarts can be part of keys
+        if isinstance(obj, numpy.generic):
+            return obj.item()
+        if callable(obj):
+            module, name = getattr(obj, "__module__", None), getattr(obj, "__qualname__", None)
+            if module in sys.modules and name and "<" not in name:
+                attr = sys.modules[module]
+                for part in name.split("."):
+                    attr = getattr(attr, part, None)
+                # bound methods or instances would resolve to a different object
+                if attr is obj:
+                    return "{}.{}".format(module, name)
+        raise TypeError("'{}' can not be used as key".format(type(obj).__name__))
+
+    def __get_features_key(self, params: dict) -> typing.Optional[str]:
+        try:
+            return hashlib.sha256(json.dumps(params, sort_keys=True, default=self.__encode_param).encode()).hexdigest()
+        except (TypeError, ValueError) as ex:
+            logger.debug("features can not be cached - {}".format(ex))
+
+    def get_features(self, checksum: str, params: dict, compute: typing.Callable[[], pandas.DataFrame]) -> pandas.DataFrame:
+        key = self.__get_features_key(params)
+        if not self.__cache_frames or not key:
+            return compute()
+        df = self.__cache.load_features(checksum, key)
+        if df is None:
+            with self.__get_lock("features-{}".format(key)):
+                df = self.__cache.load_features(checksum, key)
+                if df is None:
+                    df = compute()
+                    self.__store_features(checksum, key, df)
+            return df
+        logger.debug("using cached features '{}'".format(key))
+        return df
+
+    def get_window_features(self, checksum: str, params: dict, windows: pandas.Series, compute: typing.Callable[[list], pandas.DataFrame]) -> pandas.DataFrame:
+        # windows maps window ids to hashes of their data, only windows not contained in previous data sets are computed
+        key = self.__get_features_key(params)
+        if not self.__cache_frames or not key:
+            return compute(list(windows.index))
+        with self.__get_lock("features-{}".format(key)):
+            previous = self.__cache.find_features(checksum, key)
+            mask = numpy.zeros(len(windows), dtype=bool)
+            parts = list()
+            if previous is not None:
+                previous = previous[~previous[self.__window_column].duplicated()]
+                mask = windows.isin(previous[self.__window_column]).to_numpy()
+                rows = pandas.Series(numpy.arange(len(previous)), index=previous[self.__window_column].to_numpy())
+                parts.append(previous.iloc[rows[windows.to_numpy()[mask]].to_numpy()])
+            if mask.all():
+                logger.debug("using cached features '{}'".format(key))
+                return parts[0].drop(columns=self.__window_column)
+            computed = compute(list(windows.index[~mask]))
+            hashes = dict(zip(windows.index, windows.to_numpy()))
+            if any(window not in hashes for window in computed.index) or (parts and set(computed.columns) != set(parts[0].columns) - {self.__window_column}):
+                # features can not be assigned to windows
+                logger.warning("could not merge features '{}' - computing all windows".format(key))
+                return compute(list(windows.index))
+            parts.append(computed.assign(**{self.__window_column: [hashes[window] for window in computed.index]}))
+            df = pandas.concat(parts)
+            positions = {window: pos for pos, window in enumerate(windows.index)}
+            df = df.iloc[numpy.argsort([positions[window] for window in df.index], kind="stable")]
+            logger.debug("computed features '{}' for {} of {} windows".format(key, len(computed), len(windows)))
+            self.__store_features(checksum, key, df)
+        return df.drop(columns=self.__window_column)
+
+    def __parse_stream(self, source_id: str, metadata: models.MetaData, parse: typing.Callable[[DataStream], pandas.DataFrame]) -> pandas.DataFrame:
+        try:
+            with self.__open_stream(source_id=source_id, metadata=metadata) as stream:
+                return parse(stream)
+        except StaleChunksError as ex:
+            logger.warning("{} - retrieving all chunks".format(ex))
+        with self.__open_stream(source_id=source_id, metadata=metadata, reuse=False) as stream:
+            return parse(stream)
+
+    def get_frame(self, source_id: str, parse: typing.Callable[[DataStream], pandas.DataFrame], kind: typing.Optional[str] = None) -> typing.Tuple[pandas.DataFrame, models.MetaData]:
+        metadata = self.get_metadata(source_id)
+        if not self.__cache_frames:
+            return self.__parse_stream(source_id, metadata, parse), metadata
+        df = self.__cache.load_frame(metadata.checksum, kind)
+        if df is None:
+            with self.__get_frame_lock(metadata.checksum):
+                df = self.__cache.load_frame(metadata.checksum, kind)
+                if df is None:
+                    df = self.__parse_stream(source_id, metadata, parse)
+                    path = self.__get_tmp_path("frame")
+                    try:
+                        util.write_frame(df, path)
+                        if self.__cache.add_frame(metadata.checksum, path, kind):
+                            logger.debug("stored frame of '{}' in cache".format(source_id))
+                    except Exception as ex:
+                        logger.warning("could not store frame of '{}' in cache - {}".format(source_id, ex))
+                        shutil.rmtree(path, ignore_errors=True)
+            return df, metadata
+        logger.debug("using cached frame of '{}'".format(source_id))
+        return df, metadata
 
     def run(self) -> None:
-        stale_items = list()
         while True:
             try:
-                time.sleep(self.__max_age / 2)
-                with self.__lock:
-                    for key, item in self.__cache.items():
-                        if not item.lock.locked() and time.time() - item.created > self.__max_age:
-                            stale_items.append(key)
-                    for key in stale_items:
-                        for file in self.__cache[key].files:
-                            try:
-                                os.remove(os.path.join(self.__st_path, file))
-                            except Exception as ex:
-                                logger.warning("could not remove stale data - {}".format(ex))
-                        del self.__cache[key]
+                time.sleep(self.__clean_interval)
+                self.__cache.clean()
+                util.remove_tmp_files(self.__tmp_path)
             except Exception as ex:
-                logger.error("cleaning stale data failed - {}".format(ex))
-            stale_items.clear()
+                logger.error("cleaning cache failed - {}".format(ex))
 
-    def purge_cache(self):
+    def clean_cache(self):
+        # frames and features are written to temporary directories
+        for file in os.listdir(self.__tmp_path):
+            util.remove_tmp_file(self.__tmp_path, file)
         for file in os.listdir(self.__st_path):
+            path = os.path.join(self.__st_path, file)
+            if os.path.isfile(path) and file not in ("index.json", "index.lock"):
+                try:
+                    os.remove(path)
+                except Exception:
+                    pass
+        # worker nodes might share the cache, only locks that are not held are removed
+        for file in os.listdir(self.__locks_path):
+            path = os.path.join(self.__locks_path, file)
             try:
-                os.remove(os.path.join(self.__st_path, file))
+                with open(path, "a") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    if DownloadLock.is_current(lock_file, path):
+                        os.remove(path)
             except Exception:
                 pass
+        self.__cache.clean()
@@ -50,8 +50,8 @@ class DB:
     def list_keys(self, db: bytes) -> list:
         with self.__lock:
             partition = self.__kvs.prefixed_db(db)
-            with partition.iterator() as it:
-                return [key.decode() for key, _ in it]
+            with partition.iterator(include_value=False) as it:
+                return [key.decode() for key in it]
 
     def close(self):
         with self.__lock:
@@ -20,19 +20,38 @@ __all__ = ("Jobs",)
 from ..logger import getLogger
 from .. import event_prediction_trainer
 from .. import models
-from . import DB, Data
+from .. import util
+from . import DB, Data, Storage
 import threading
-import queue
+import collections
 import typing
 import uuid
 import datetime
 import base64
-import gzip
 import json
 import time
 import multiprocessing
+import multiprocessing.connection
+import concurrent.futures
 import signal
 import sys
+import os
+import hashlib
+import functools
+import resource
+import pandas
+
+try:
+    import tsfresh
+    import tsfresh.feature_extraction
+    import tsfresh.utilities.distribution
+except ImportError:
+    tsfresh = None
+
+try:
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
 
 
 logger = getLogger(__name__.split(".", 1)[-1])
@@ -43,147 +62,944 @@ def handle_sigterm(signo, stack_frame):
     sys.exit(0)
 
 
-# temporary workaround for code not supporting chunked data --->
-class ConcatenatedFile:
-    def __init__(self, files):
-        self.__chunks = files
+def set_affinity(pid: int, cores: typing.List[int]):
+    # applies to all threads of the process, threads created later inherit the affinity
+    try:
+        for tid in os.listdir("/proc/{}/task".format(pid)):
+            try:
+                os.sched_setaffinity(int(tid), cores)
+            except ProcessLookupError:
+                pass
+    except Exception as ex:
+        logger.warning("could not set cpu affinity of '{}' - {}".format(pid, ex))
+
+
+def set_thread_limit(limit: int):
+    # environment variables affect libraries initialized later, threadpoolctl adjusts loaded ones
+    for var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS", "VECLIB_MAXIMUM_THREADS"):
+        os.environ[var] = str(limit)
+    if threadpoolctl:
+        threadpoolctl.threadpool_limits(limits=limit)
+
+
+if tsfresh:
+    class ThreadDistributor(tsfresh.utilities.distribution.IterableDistributorBaseClass):
+        # worker processes are daemons and can't start the process pool tsfresh uses for n_jobs > 1
+        def __init__(self, n_workers: int, disable_progressbar: bool = False, progressbar_title: str = "Feature Extraction"):
+            self.n_workers = n_workers
+            self.disable_progressbar = disable_progressbar
+            self.progressbar_title = progressbar_title
+            self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="jobs-features")
+
+        def distribute(self, func, partitioned_chunks, kwargs):
+            return self.__executor.map(functools.partial(func, **kwargs), partitioned_chunks)
+
+        def close(self):
+            self.__executor.shutdown()
+
+
+class CachedFeatureExtraction:
+    __ignored_args = ("n_jobs", "chunksize", "distributor", "disable_progressbar", "show_warnings", "profile", "profiling_filename", "profiling_sorting")
+    __instance = None
+
+    def __init__(self, data_handler: Data, checksum: str, incremental: bool, cache: bool, n_jobs: typing.Optional[int], extract: typing.Callable):
+        self.__data_handler = data_handler
+        self.__extract = extract
+        self.checksum = checksum
+        self.incremental = incremental
+        self.cache = cache
+        self.n_jobs = n_jobs
+
+    def __set_n_jobs(self, kwargs: dict):
+        # tsfresh defaults to all cpus, extraction is limited to the cores assigned to the job
+        if self.n_jobs is None:
+            return
+        kwargs["n_jobs"] = self.n_jobs if self.n_jobs > 1 else 0
+        if self.n_jobs > 1 and kwargs.get("distributor") is None and multiprocessing.current_process().daemon:
+            kwargs["distributor"] = ThreadDistributor(n_workers=self.n_jobs, disable_progressbar=kwargs.get("disable_progressbar", False))
+
+    @staticmethod
+    def __hash_windows(timeseries_container: pandas.DataFrame, column_id: str) -> pandas.Series:
+        # order sensitive, row hashes are combined by summing their halves to avoid overflows
+        rows = pandas.util.hash_pandas_object(timeseries_container, index=False).to_numpy()
+        positions = timeseries_container.groupby(column_id, sort=True).cumcount().to_numpy().astype("uint64")
+        rows = pandas.util.hash_array(rows ^ positions)
+        sums = pandas.DataFrame(
+            {"low": rows & 0xFFFFFFFF, "high": rows >> 32},
+            index=timeseries_container.index
+        ).groupby(timeseries_container[column_id], sort=True).sum()
+        return pandas.Series(
+            ((sums["high"].to_numpy() & 0xFFFFFFFF) << 32) | (sums["low"].to_numpy() & 0xFFFFFFFF),
+            index=sums.index
+        )
 
-    def __read(self, n=65536):
-        for chunk in self.__chunks:
-            file = open(chunk, "rb")
-            buffer = file.read(n)
-            while buffer:
-                yield buffer
-                buffer = file.read(n)
-            file.close()
+    def __call__(self, timeseries_container, *args, **kwargs):
+        self.__set_n_jobs(kwargs)
+        if not self.cache or not isinstance(timeseries_container, pandas.DataFrame):
+            return self.__extract(timeseries_container, *args, **kwargs)
+        # the container is the result of all preprocessing steps, hashing it is cheap compared to the extraction
+        params = {key: value for key, value in kwargs.items() if key not in self.__ignored_args}
+        params["args"] = args
+        params["columns"] = [str(column) for column in timeseries_container.columns]
+        column_id = kwargs.get("column_id")
+        # imputation depends on all windows, features can only be computed per window without it
+        if self.incremental and column_id in timeseries_container.columns and kwargs.get("impute_function") is None:
+            windows = self.__hash_windows(timeseries_container, column_id)
+            # windows that precede appended data are unchanged, the first one identifies the preprocessing
+            params["lineage"] = str(windows.iloc[0]) if len(windows) else None
+            return self.__data_handler.get_window_features(
+                checksum=self.checksum,
+                params=params,
+                windows=windows,
+                compute=lambda ids: self.__extract(timeseries_container[timeseries_container[column_id].isin(ids)], *args, **kwargs)
+            )
+        params["container"] = hashlib.sha256(pandas.util.hash_pandas_object(timeseries_container, index=True).to_numpy().tobytes()).hexdigest()
+        return self.__data_handler.get_features(
+            checksum=self.checksum,
+            params=params,
+            compute=lambda: self.__extract(timeseries_container, *args, **kwargs)
+        )
 
-    def build_input(self):
-        path = "/data_cache/{}".format(uuid.uuid4().hex)
-        with open(path, "wb") as file:
-            for buffer in self.__read():
-                file.write(buffer)
-        return path
-# <-------------------------------------------------------------
+    @classmethod
+    def install(cls, data_handler: Data, checksum: str, incremental: bool, cache: bool, n_jobs: typing.Optional[int]):
+        # replaces extract_features where the trainer's modules imported it, only affects the current worker process
+        if not tsfresh:
+            return
+        if cls.__instance:
+            cls.__instance.checksum = checksum
+            cls.__instance.incremental = incremental
+            cls.__instance.cache = cache
+            cls.__instance.n_jobs = n_jobs
+            return
+        extract = tsfresh.extract_features
+        cls.__instance = cls(data_handler=data_handler, checksum=checksum, incremental=incremental, cache=cache, n_jobs=n_jobs, extract=extract)
+        count = 0
+        for module in list(sys.modules.values()):
+            if getattr(module, "__name__", "").startswith(event_prediction_trainer.__name__):
+                for name, attr in list(vars(module).items()):
+                    if attr is extract:
+                        setattr(module, name, cls.__instance)
+                        count += 1
+        if not count:
+            logger.warning("extract_features not imported by the trainer - features are not cached or limited")
 
 
 class Result:
     def __init__(self):
         self.model_item: typing.Optional[models.Model] = None
+        self.data_path: typing.Optional[str] = None
+        self.variant: typing.Optional[models.JobVariant] = None
         self.job: typing.Optional[models.Job] = None
         self.error = False
+        self.retire = False
+
+
+class Lease:
+    def __init__(self, job_id: str, worker: str, lease_time: typing.Union[int, float]):
+        self.job_id = job_id
+        self.worker = worker
+        self.started = time.monotonic()
+        self.expires = self.started + lease_time
 
 
 class Worker(multiprocessing.Process):
-    def __init__(self, job: models.Job, model_item: models.Model, data_handler: Data):
-        super().__init__(name="jobs-worker-{}".format(job.id), daemon=True)
-        self.__model_item = model_item
+    __page_size = os.sysconf("SC_PAGE_SIZE")
+
+    def __init__(self, number: int, data_handler: Data, storage_handler: Storage, compact_data: bool, cache_features: bool, incremental_features: bool, track_data_size: bool, grid_threads: int, max_jobs: int, max_memory: int, job_max_memory: int):
+        super().__init__(name="jobs-worker-{}".format(number), daemon=True)
         self.__data_handler = data_handler
-        self.__job = job
-        self.result = multiprocessing.Queue()
+        self.__storage_handler = storage_handler
+        self.__compact_data = compact_data
+        self.__cache_features = cache_features
+        self.__incremental_features = incremental_features
+        self.__track_data_size = track_data_size
+        self.__grid_threads = grid_threads
+        self.__max_jobs = max_jobs
+        self.__max_memory = max_memory
+        self.__job_max_memory = job_max_memory
+        self.__memory_exceeded = False
+        self.__data_size: typing.Optional[int] = None
+        self.__lock = threading.Lock()
+        self.__job: typing.Optional[models.Job] = None
+        self.conn, self.__conn = multiprocessing.Pipe()
 
-    def run(self) -> None:
-        signal.signal(signal.SIGTERM, handle_sigterm)
-        signal.signal(signal.SIGINT, handle_sigterm)
+    def __send(self, result_obj: Result):
+        with self.__lock:
+            self.__conn.send(result_obj)
+
+    def __set_memory_limit(self, limit: int):
+        # the soft limit applies per job, the hard limit is left untouched so it can be raised again
+        soft, hard = resource.getrlimit(resource.RLIMIT_DATA)
+        if not limit or (hard != resource.RLIM_INFINITY and limit > hard):
+            limit = hard
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, hard))
+
+    def __get_memory(self) -> int:
+        # resident memory without shared pages, file backed pages of memory mapped frames can be reclaimed by the kernel
+        with open("/proc/self/statm", "r") as file:
+            values = file.read().split()
+        return (int(values[1]) - int(values[2])) * self.__page_size
+
+    def __get_data(self, service_id: str) -> typing.Tuple[pandas.DataFrame, models.MetaData]:
+        if self.__compact_data:
+            return self.__data_handler.get_frame(
+                source_id=service_id,
+                parse=lambda stream: util.read_csv(
+                    path=stream.path,
+                    time_field=stream.time_field,
+                    columns=stream.columns,
+                    default_values=stream.default_values
+                ),
+                kind="compact"
+            )
+        return self.__data_handler.get_frame(
+            source_id=service_id,
+            parse=lambda stream: event_prediction_trainer.pipeline.df_from_csv(
+                csv_path=stream.path,
+                time_col=stream.time_field,
+                sorted=True
+            )
+        )
+
+    def __train(self, model_item: models.Model, df: pandas.DataFrame, metadata: models.MetaData, result_obj: Result):
+        config = event_prediction_trainer.config.config_from_dict(model_item.config)
+        model_item.columns = metadata.columns
+        model_item.default_values = metadata.default_values
+        model_item.time_field = metadata.time_field
+        model_item.data_checksum = metadata.checksum
+        model_item.data_size = self.__data_size
+        logger.debug(
+            "{}: training model for prediction of '{}' for '{}' ...".format(
+                self.__job.id, config["target_errorCode"],
+                config["target_col"]
+            )
+        )
+        # the model is written to storage by the worker, only its metadata is sent back
+        result_obj.data_path, model_item.data_digest = self.__storage_handler.write(
+            event_prediction_trainer.pipeline.run_pipeline(df=df, config=config)
+        )
+        model_item.data_format = self.__storage_handler.data_format
+        model_item.data_codec = self.__storage_handler.codec
+        model_item.created = "{}Z".format(datetime.datetime.utcnow().isoformat())
+        result_obj.model_item = model_item
+
+    def __train_variant(self, model_item: models.Model, df: pandas.DataFrame, metadata: models.MetaData):
+        result_obj = Result()
+        result_obj.variant = models.JobVariant(model_id=model_item.id, status=models.JobStatus.running)
+        self.__send(result_obj)
+        result_obj = Result()
+        result_obj.variant = models.JobVariant(model_id=model_item.id)
+        try:
+            self.__train(model_item=model_item, df=df, metadata=metadata, result_obj=result_obj)
+            result_obj.variant.status = models.JobStatus.finished
+            logger.debug("{}: variant '{}' completed successfully".format(self.__job.id, model_item.id))
+        except MemoryError:
+            self.__memory_exceeded = True
+            result_obj.variant.status = models.JobStatus.aborted
+            result_obj.variant.reason = "memory limit exceeded"
+            logger.error("{}: variant '{}' aborted - memory limit exceeded".format(self.__job.id, model_item.id))
+            result_obj.error = True
+        except Exception as ex:
+            result_obj.variant.status = models.JobStatus.failed
+            result_obj.variant.reason = str(ex)
+            logger.error("{}: variant '{}' failed - {}".format(self.__job.id, model_item.id, ex))
+            result_obj.error = True
+        self.__send(result_obj)
+        return result_obj.error
+
+    def __run_job(self, job: models.Job, model_items: typing.List[models.Model], cores: typing.Optional[typing.List[int]]) -> Result:
+        self.__job = job
+        self.__memory_exceeded = False
         result_obj = Result()
         try:
             logger.debug("starting job '{}' ...".format(self.__job.id))
+            if cores:
+                set_thread_limit(len(cores))
+            self.__set_memory_limit(self.__job_max_memory)
             self.__job.status = models.JobStatus.running
-            config = event_prediction_trainer.config.config_from_dict(self.__model_item.config)
-            files, self.__model_item.columns, self.__model_item.default_values, self.__model_item.time_field = self.__data_handler.get(source_id=self.__model_item.service_id)
-            input_path = ConcatenatedFile(files=files).build_input()
-            logger.debug(
-                "{}: training model for prediction of '{}' for '{}' ...".format(
-                    self.__job.id, config["target_errorCode"],
-                    config["target_col"]
-                )
+            df, metadata = self.__get_data(service_id=model_items[0].service_id)
+            # the size is only used by the scheduler to skip retraining on small changes
+            self.__data_size = self.__data_handler.get_size(source_id=model_items[0].service_id, metadata=metadata) if self.__track_data_size else None
+            n_jobs = None
+            if cores:
+                # concurrent grid variants split the job's cores
+                n_jobs = max(1, len(cores) // max(1, min(self.__grid_threads, len(model_items)))) if self.__job.model_ids else len(cores)
+            CachedFeatureExtraction.install(
+                data_handler=self.__data_handler,
+                checksum=metadata.checksum,
+                incremental=self.__incremental_features,
+                cache=self.__cache_features,
+                n_jobs=n_jobs
             )
-            self.__model_item.data = base64.standard_b64encode(
-                gzip.compress(
-                    event_prediction_trainer.pipeline.clf_to_pickle_bytes(
-                        event_prediction_trainer.pipeline.run_pipeline(
-                            df=event_prediction_trainer.pipeline.df_from_csv(
-                                csv_path=input_path,
-                                time_col=self.__model_item.time_field,
-                                sorted=True
-                            ),
-                            config=config
-                        )
-                    )
-                )
-            ).decode()
-            self.__model_item.created = "{}Z".format(datetime.datetime.utcnow().isoformat())
-            result_obj.model_item = self.__model_item
+            if self.__job.model_ids:
+                # variants run concurrently, the pipeline might modify data in place which must not affect other variants or the cached frame
+                with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.__grid_threads), thread_name_prefix="jobs-grid") as executor:
+                    errors = list(executor.map(lambda model_item: self.__train_variant(model_item, df.copy(), metadata), model_items))
+                if self.__memory_exceeded:
+                    raise MemoryError()
+                if all(errors):
+                    raise RuntimeError("all variants failed")
+                if any(errors):
+                    self.__job.reason = "{} of {} variants failed".format(sum(errors), len(errors))
+            else:
+                self.__train(model_item=model_items[0], df=df, metadata=metadata, result_obj=result_obj)
             self.__job.status = models.JobStatus.finished
             logger.debug("{}: completed successfully".format(self.__job.id))
+        except MemoryError:
+            self.__job.status = models.JobStatus.aborted
+            self.__job.reason = "memory limit of {} MB exceeded".format(self.__job_max_memory // 1048576)
+            logger.error("{}: aborted - {}".format(self.__job.id, self.__job.reason))
+            result_obj.error = True
+            # memory might be fragmented or leaked after running out of it
+            result_obj.retire = True
         except Exception as ex:
             self.__job.status = models.JobStatus.failed
             self.__job.reason = str(ex)
             logger.error("{}: failed - {}".format(self.__job.id, ex))
             result_obj.error = True
+        finally:
+            self.__set_memory_limit(0)
         result_obj.job = self.__job
-        self.result.put(result_obj)
+        return result_obj
+
+    def start(self):
+        super().start()
+        self.__conn.close()
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, handle_sigterm)
+        signal.signal(signal.SIGINT, handle_sigterm)
+        self.conn.close()
+        count = 0
+        while True:
+            try:
+                job, model_items, cores = self.__conn.recv()
+            except EOFError:
+                break
+            result_obj = self.__run_job(job=job, model_items=model_items, cores=cores)
+            count += 1
+            if result_obj.retire:
+                logger.debug("{}: retiring after running out of memory".format(self.name))
+            elif self.__max_jobs and count >= self.__max_jobs:
+                logger.debug("{}: retiring after {} jobs".format(self.name, count))
+                result_obj.retire = True
+            elif self.__max_memory and self.__get_memory() > self.__max_memory:
+                logger.debug("{}: retiring due to memory usage".format(self.name))
+                result_obj.retire = True
+            try:
+                self.__send(result_obj)
+            except BrokenPipeError:
+                logger.warning("{}: could not send result of job '{}' - exiting".format(self.name, job.id))
+                break
+            if result_obj.retire:
+                break
+
+
+class WorkerPool:
+    def __init__(self, data_handler: Data, storage_handler: Storage, compact_data: bool, cache_features: bool, incremental_features: bool, track_data_size: bool, grid_threads: int, max_jobs: int, max_memory: int, job_max_memory: int):
+        self.__data_handler = data_handler
+        self.__storage_handler = storage_handler
+        self.__compact_data = compact_data
+        self.__cache_features = cache_features
+        self.__incremental_features = incremental_features
+        self.__track_data_size = track_data_size
+        self.__grid_threads = grid_threads
+        self.__max_jobs = max_jobs
+        self.__max_memory = max_memory
+        self.__job_max_memory = job_max_memory
+        self.__workers: typing.List[Worker] = list()
+        self.__count = 0
+
+    def __iter__(self) -> typing.Iterator[Worker]:
+        return iter(list(self.__workers))
+
+    def __len__(self) -> int:
+        return len(self.__workers)
+
+    def add(self) -> Worker:
+        self.__count += 1
+        worker = Worker(
+            number=self.__count,
+            data_handler=self.__data_handler,
+            storage_handler=self.__storage_handler,
+            compact_data=self.__compact_data,
+            cache_features=self.__cache_features,
+            incremental_features=self.__incremental_features,
+            track_data_size=self.__track_data_size,
+            grid_threads=self.__grid_threads,
+            max_jobs=self.__max_jobs,
+            max_memory=self.__max_memory,
+            job_max_memory=self.__job_max_memory
+        )
+        worker.start()
+        self.__workers.append(worker)
+        logger.debug("started '{}'".format(worker.name))
+        return worker
+
+    def remove(self, worker: Worker, stop: bool = False):
+        if stop:
+            worker.terminate()
+        worker.join(timeout=5)
+        if worker.is_alive():
+            worker.kill()
+            worker.join()
+        worker.conn.close()
+        self.__workers.remove(worker)
+        self.__data_handler.remove_tmp_files(worker.pid)
+        self.__storage_handler.remove_tmp_files(worker.pid)
+
+    def get_idle(self, busy: typing.Iterable[Worker]) -> typing.Optional[Worker]:
+        busy = list(busy)
+        for worker in self.__workers:
+            if worker not in busy:
+                return worker
 
 
 class Jobs(threading.Thread):
-    def __init__(self, db_handler: DB, data_handler: Data, check_delay: typing.Union[int, float], max_jobs: int):
+    def __init__(self, db_handler: DB, data_handler: Data, storage_handler: Storage, check_delay: typing.Union[int, float], max_jobs: int, max_memory: int, max_cpus: int, cpu_affinity: bool, job_timeout: typing.Union[int, float], job_max_memory: int, lease_time: typing.Union[int, float], memory_factor: typing.Union[int, float], compact_data: bool, cache_features: bool, incremental_features: bool, track_data_size: bool, grid_threads: int, worker_max_jobs: int, worker_max_memory: int):
         super().__init__(name="jobs-handler", daemon=True)
         self.__db_handler = db_handler
         self.__data_handler = data_handler
+        self.__storage_handler = storage_handler
         self.__check_delay = check_delay
         self.__max_jobs = max_jobs
-        self.__job_queue = queue.Queue()
+        self.__max_memory = max_memory * 1048576
+        self.__max_cpus = max_cpus or os.cpu_count() or 1
+        self.__cores: typing.List[int] = list()
+        if cpu_affinity and hasattr(os, "sched_setaffinity"):
+            self.__cores = sorted(os.sched_getaffinity(0))[:self.__max_cpus]
+        self.__job_cores: typing.Dict[str, typing.List[int]] = dict()
+        self.__memory_factor = memory_factor
+        self.__job_timeout = job_timeout
+        self.__job_max_memory = job_max_memory * 1048576
+        self.__lease_time = lease_time
+        self.__grid_threads = grid_threads
+        self.__lock = threading.Lock()
+        self.__job_queues: typing.Dict[str, typing.List[str]] = collections.OrderedDict()
+        self.__job_costs: typing.Dict[str, typing.Tuple[int, int]] = dict()
+        self.__job_started: typing.Dict[str, float] = dict()
+        self.__abort_requests: typing.Dict[str, str] = dict()
         self.__job_pool: typing.Dict[str, models.Job] = dict()
+        self.__model_jobs: typing.Dict[str, str] = dict()
         self.__worker_pool: typing.Dict[str, Worker] = dict()
-
-    def create(self, model_id: str) -> str:
-        for job in self.__job_pool.values():
-            if job.model_id == model_id:
-                logger.debug("job for model '{}' already exists".format(model_id))
-                return job.id
-        job = models.Job(
-            id=uuid.uuid4().hex,
-            model_id=model_id,
-            created="{}Z".format(datetime.datetime.utcnow().isoformat())
+        self.__workers = WorkerPool(
+            data_handler=data_handler,
+            storage_handler=storage_handler,
+            compact_data=compact_data,
+            cache_features=cache_features,
+            incremental_features=incremental_features,
+            track_data_size=track_data_size,
+            grid_threads=grid_threads,
+            max_jobs=worker_max_jobs,
+            max_memory=worker_max_memory * 1048576,
+            job_max_memory=self.__job_max_memory
         )
+        self.__leases: typing.Dict[str, Lease] = dict()
+        self.__job_leases: typing.Dict[str, str] = dict()
+        self.__wakeup_r, self.__wakeup_w = os.pipe()
+        os.set_blocking(self.__wakeup_r, False)
+        os.set_blocking(self.__wakeup_w, False)
+        self.__migrate()
+        self.__remove_orphans()
+        self.__recover()
+
+    def __migrate(self):
+        # models stored with the binary as part of the metadata, all of them are gzip compressed pickles
+        count = 0
+        for model_id in self.__db_handler.list_keys(b"models-"):
+            try:
+                model_item = models.Model(json.loads(self.__db_handler.get(b"models-", model_id.encode())))
+                if model_item.data:
+                    self.__store_model(model_item)
+                    count += 1
+            except Exception as ex:
+                logger.error("could not migrate model '{}' - {}".format(model_id, ex))
+        if count:
+            logger.info("migrated {} models".format(count))
+
+    def __remove_orphans(self):
+        # binaries of models that were replaced or deleted while the trainer was interrupted
+        stored = set()
+        for model_id in self.__db_handler.list_keys(b"models-"):
+            try:
+                stored.add((model_id, models.Model(json.loads(self.__db_handler.get(b"models-", model_id.encode()))).data_digest))
+            except Exception as ex:
+                logger.error("could not read model '{}' - {}".format(model_id, ex))
+                return
+        for model_id, digest in self.__storage_handler.list_files():
+            if (model_id, digest) not in stored:
+                logger.debug("removing orphaned binary of model '{}'".format(model_id))
+                self.__storage_handler.delete(model_id, digest)
+
+    def __store_model(self, model_item: models.Model, data_path: typing.Optional[str] = None):
+        # the binary is stored first, metadata is read frequently and must not contain it, the availability index is written last
+        try:
+            previous = models.Model(json.loads(self.__db_handler.get(b"models-", model_item.id.encode()))).data_digest
+        except KeyError:
+            previous = None
+        if data_path:
+            self.__storage_handler.commit(model_item.id, model_item.data_digest, data_path)
+        else:
+            model_item.data_digest = self.__storage_handler.put(model_item.id, base64.standard_b64decode(model_item.data))
+            model_item.data_format = model_item.data_format or "pickle"
+            model_item.data_codec = model_item.data_codec or "gzip"
+        model_item.data = None
+        self.__db_handler.put(b"models-", model_item.id.encode(), json.dumps(dict(model_item)).encode())
+        self.__db_handler.put(b"available-", model_item.id.encode(), model_item.created.encode())
+        # readers either opened the previous binary already or read the new metadata
+        if previous and previous != model_item.data_digest:
+            self.__storage_handler.delete(model_item.id, previous)
+
+    def __recover(self):
+        # queued and running jobs are stored until they end, jobs interrupted by a restart are queued again
+        jobs = [models.Job(json.loads(self.__db_handler.get(b"queue-", job_id.encode()))) for job_id in self.__db_handler.list_keys(b"queue-")]
+        with self.__lock:
+            for job in sorted(jobs, key=lambda job: job.created):
+                self.__requeue(job)
+        if jobs:
+            logger.info("recovered {} jobs".format(len(jobs)))
+
+    def __requeue(self, job: models.Job) -> bool:
+        # finished variants of grid jobs are kept, requires lock
+        if job.model_ids:
+            job.model_ids = [model_id for model_id in job.model_ids if job.variants[model_id]["status"] != models.JobStatus.finished]
+            if not job.model_ids:
+                job.status = models.JobStatus.finished
+                self.__store(job)
+                return False
+        job.status = models.JobStatus.pending
+        self.__enqueue(job)
+        return True
+
+    def __get_existing(self, model_id: str, priority: int) -> typing.Optional[str]:
+        # requests with a higher priority raise the priority of the existing job, requires lock
+        job_id = self.__model_jobs.get(model_id)
+        if job_id:
+            logger.debug("job for model '{}' already exists".format(model_id))
+            job = self.__job_pool[job_id]
+            if priority > job.priority:
+                job.priority = priority
+                self.__db_handler.put(b"queue-", job.id.encode(), json.dumps(dict(job)).encode())
+                job_ids = self.__job_queues.get(job.service_id, list())
+                if job_id in job_ids:
+                    job_ids.remove(job_id)
+                    self.__insert(job)
+                logger.debug("raised priority of job '{}' to {}".format(job_id, priority))
+        return job_id
+
+    def __enqueue(self, job: models.Job):
+        # requires lock
+        self.__db_handler.put(b"queue-", job.id.encode(), json.dumps(dict(job)).encode())
         self.__job_pool[job.id] = job
+        for model_id in job.model_ids or [job.model_id]:
+            self.__model_jobs[model_id] = job.id
+        self.__insert(job)
+
+    def __insert(self, job: models.Job):
+        # jobs of a service are ordered by priority, services take turns, requires lock
+        job_ids = self.__job_queues.setdefault(job.service_id, list())
+        pos = len(job_ids)
+        for i in range(len(job_ids)):
+            if job.priority > self.__job_pool[job_ids[i]].priority:
+                pos = i
+                break
+        job_ids.insert(pos, job.id)
+
+    def __remove_job(self, job_id: str):
+        with self.__lock:
+            job = self.__job_pool.pop(job_id)
+            for model_id in job.model_ids or [job.model_id]:
+                if self.__model_jobs.get(model_id) == job_id:
+                    del self.__model_jobs[model_id]
+
+    def create(self, model_id: str, priority: int = 0) -> str:
+        with self.__lock:
+            job_id = self.__get_existing(model_id, priority)
+            if job_id:
+                return job_id
+            job = models.Job(
+                id=uuid.uuid4().hex,
+                model_id=model_id,
+                service_id=models.Model(json.loads(self.__db_handler.get(b"models-", model_id.encode()))).service_id,
+                priority=priority,
+                created="{}Z".format(datetime.datetime.utcnow().isoformat())
+            )
+            self.__enqueue(job)
+        self.__notify()
         logger.debug("created job for model '{}'".format(model_id))
-        self.__job_queue.put_nowait(job.id)
         return job.id
 
+    def create_grid(self, model_ids: list, priority: int = 0) -> list:
+        with self.__lock:
+            new_ids = [model_id for model_id in model_ids if not self.__get_existing(model_id, priority)]
+            if self.__grid_threads > 0 and len(new_ids) > 1:
+                job = models.Job(
+                    id=uuid.uuid4().hex,
+                    model_ids=new_ids,
+                    variants={model_id: dict(models.JobVariant(model_id=model_id)) for model_id in new_ids},
+                    service_id=models.Model(json.loads(self.__db_handler.get(b"models-", new_ids[0].encode()))).service_id,
+                    priority=priority,
+                    created="{}Z".format(datetime.datetime.utcnow().isoformat())
+                )
+                self.__enqueue(job)
+            else:
+                job = None
+        if not job:
+            return [self.create(model_id=model_id, priority=priority) for model_id in model_ids]
+        self.__notify()
+        logger.debug("created grid job for {} models".format(len(new_ids)))
+        return [job.id]
+
+    def find_job(self, model_id: str) -> typing.Optional[str]:
+        return self.__model_jobs.get(model_id)
+
     def get_job(self, job_id: str) -> models.Job:
         return self.__job_pool[job_id]
 
     def list_jobs(self) -> list:
         return list(self.__job_pool.keys())
 
+    def __handle_result(self, job_id: str, res: Result):
+        if res.model_item and not res.error:
+            self.__store_model(res.model_item, res.data_path)
+        if res.variant:
+            self.__job_pool[job_id].variants[res.variant.model_id] = dict(res.variant)
+            if res.variant.status != models.JobStatus.running:
+                self.__db_handler.put(b"queue-", job_id.encode(), json.dumps(dict(self.__job_pool[job_id])).encode())
+        if res.job:
+            if res.job.variants:
+                res.job.variants = self.__job_pool[job_id].variants
+            self.__store(res.job)
+
+    def __store(self, job: models.Job):
+        self.__db_handler.put(b"jobs-", job.id.encode(), json.dumps(dict(job)).encode())
+        self.__db_handler.delete(b"queue-", job.id.encode())
+
+    def __store_job(self, job_id: str, status: str, reason: str):
+        job = self.__job_pool[job_id]
+        job.status = status
+        job.reason = reason
+        for variant in (job.variants or dict()).values():
+            if variant["status"] in (models.JobStatus.pending, models.JobStatus.running):
+                variant["status"] = status
+        self.__store(job)
+
+    def __release(self, job_id: str):
+        del self.__worker_pool[job_id]
+        del self.__job_costs[job_id]
+        del self.__job_started[job_id]
+        self.__job_cores.pop(job_id, None)
+        self.__rebalance()
+        self.__remove_job(job_id)
+
+    def __get_model_items(self, job_id: str) -> typing.Optional[typing.List[models.Model]]:
+        job = self.__job_pool[job_id]
+        try:
+            return [
+                models.Model(json.loads(self.__db_handler.get(b"models-", model_id.encode())))
+                for model_id in job.model_ids or [job.model_id]
+            ]
+        except KeyError as ex:
+            # models might have been deleted while the job was queued
+            self.__fail(job_id, "model '{}' not found".format(ex.args[0].decode()))
+        except Exception as ex:
+            self.__fail(job_id, str(ex))
+
+    def __fail(self, job_id: str, reason: str):
+        # queued jobs that can not be started must not block the queue
+        if self.__dequeue(job_id):
+            logger.error("job '{}' failed - {}".format(job_id, reason))
+            self.__store_job(job_id, models.JobStatus.failed, reason)
+            self.__remove_job(job_id)
+
+    def claim(self, worker: str) -> typing.Optional[models.Lease]:
+        while True:
+            job_id = self.__next_job()
+            if not job_id:
+                return None
+            model_items = self.__get_model_items(job_id)
+            if model_items is not None and self.__dequeue(job_id):
+                break
+        job = self.__job_pool[job_id]
+        lease_id = uuid.uuid4().hex
+        with self.__lock:
+            self.__leases[lease_id] = Lease(job_id=job_id, worker=worker, lease_time=self.__lease_time)
+            self.__job_leases[job_id] = lease_id
+        job.status = models.JobStatus.running
+        self.__db_handler.put(b"queue-", job_id.encode(), json.dumps(dict(job)).encode())
+        logger.debug("leased job '{}' to '{}'".format(job_id, worker))
+        return models.Lease(
+            id=lease_id,
+            worker=worker,
+            job=dict(job),
+            models=[dict(model_item) for model_item in model_items],
+            lease_time=self.__lease_time
+        )
+
+    def renew(self, lease_id: str):
+        with self.__lock:
+            self.__leases[lease_id].expires = time.monotonic() + self.__lease_time
+
+    def complete(self, lease_id: str, result: models.JobResult):
+        res = Result()
+        res.model_item = models.Model(result.model_item) if result.model_item else None
+        res.variant = models.JobVariant(result.variant) if result.variant else None
+        res.job = models.Job(result.job) if result.job else None
+        res.error = result.error
+        with self.__lock:
+            lease = self.__leases[lease_id]
+            # results may only refer to the leased job and its models
+            job = self.__job_pool[lease.job_id]
+            model_ids = job.model_ids or [job.model_id]
+            if res.model_item and res.model_item.id not in model_ids:
+                raise ValueError("model '{}' is not part of job '{}'".format(res.model_item.id, lease.job_id))
+            if res.variant and res.variant.model_id not in model_ids:
+                raise ValueError("variant '{}' is not part of job '{}'".format(res.variant.model_id, lease.job_id))
+            if res.job and res.job.id != lease.job_id:
+                raise ValueError("job '{}' does not match leased job '{}'".format(res.job.id, lease.job_id))
+            if res.job:
+                del self.__leases[lease_id]
+                del self.__job_leases[lease.job_id]
+            else:
+                lease.expires = time.monotonic() + self.__lease_time
+        self.__handle_result(lease.job_id, res)
+        if res.job:
+            self.__remove_job(lease.job_id)
+            logger.debug("job '{}' completed by '{}'".format(lease.job_id, lease.worker))
+
+    def release(self, lease_id: str):
+        with self.__lock:
+            lease = self.__leases.pop(lease_id)
+            del self.__job_leases[lease.job_id]
+            queued = self.__requeue(self.__job_pool[lease.job_id])
+        if queued:
+            self.__notify()
+        else:
+            self.__remove_job(lease.job_id)
+        logger.debug("job '{}' released by '{}'".format(lease.job_id, lease.worker))
+
+    def __check_leases(self):
+        now = time.monotonic()
+        with self.__lock:
+            leases = list(self.__leases.items())
+        for lease_id, lease in leases:
+            if self.__job_timeout and now - lease.started > self.__job_timeout:
+                self.__abort(lease.job_id, "timeout of {}s exceeded".format(self.__job_timeout))
+            elif lease.expires < now:
+                logger.warning("lease of job '{}' held by '{}' expired".format(lease.job_id, lease.worker))
+                try:
+                    self.release(lease_id)
+                except KeyError:
+                    pass
+
+    def __get_timeout(self) -> float:
+        with self.__lock:
+            deadlines = [lease.expires for lease in self.__leases.values()]
+            if self.__job_timeout:
+                deadlines += [lease.started + self.__job_timeout for lease in self.__leases.values()]
+        if self.__job_timeout:
+            deadlines += [started + self.__job_timeout for started in self.__job_started.values()]
+        if not deadlines:
+            return self.__check_delay
+        return min(self.__check_delay, max(0, min(deadlines) - time.monotonic()))
+
+    def abort(self, job_id: str, reason: str = "aborted by request"):
+        with self.__lock:
+            if job_id not in self.__job_pool:
+                raise KeyError(job_id)
+            self.__abort_requests[job_id] = reason
+        self.__notify()
+
+    def __abort(self, job_id: str, reason: str):
+        if job_id not in self.__job_pool:
+            return
+        with self.__lock:
+            # workers holding the lease are informed by the next heartbeat
+            lease_id = self.__job_leases.pop(job_id, None)
+            if lease_id:
+                del self.__leases[lease_id]
+        if job_id in self.__worker_pool:
+            # results sent before the abort are kept
+            self.__check_worker(job_id)
+            if job_id not in self.__job_pool:
+                return
+            worker = self.__worker_pool[job_id]
+            self.__store_job(job_id, models.JobStatus.aborted, reason)
+            self.__release(job_id)
+            self.__workers.remove(worker, stop=True)
+        else:
+            self.__dequeue(job_id)
+            self.__store_job(job_id, models.JobStatus.aborted, reason)
+            self.__remove_job(job_id)
+        logger.warning("aborted job '{}' - {}".format(job_id, reason))
+
+    def __check_aborts(self):
+        with self.__lock:
+            requests = self.__abort_requests
+            self.__abort_requests = dict()
+        for job_id, reason in requests.items():
+            self.__abort(job_id, reason)
+        if self.__job_timeout:
+            now = time.monotonic()
+            for job_id, started in list(self.__job_started.items()):
+                if now - started > self.__job_timeout:
+                    self.__abort(job_id, "timeout of {}s exceeded".format(self.__job_timeout))
+
+    def __check_worker(self, job_id: str):
+        worker = self.__worker_pool[job_id]
+        finished = False
+        retire = False
+        try:
+            while not finished and worker.conn.poll():
+                res = worker.conn.recv()
+                self.__handle_result(job_id, res)
+                if res.job:
+                    finished = True
+                    retire = res.retire
+        except (EOFError, OSError):
+            pass
+        if not finished and worker.is_alive():
+            return
+        if not finished:
+            logger.error("job '{}' quit with exitcode '{}'".format(job_id, worker.exitcode))
+            self.__store_job(job_id, models.JobStatus.failed, "worker quit with exitcode '{}'".format(worker.exitcode))
+            retire = True
+        self.__release(job_id)
+        if retire:
+            self.__workers.remove(worker)
+
+    def __notify(self):
+        try:
+            os.write(self.__wakeup_w, b"\0")
+        except BlockingIOError:
+            pass
+
+    @staticmethod
+    def __get_window_length(model_item: models.Model) -> int:
+        try:
+            return max(0, int(model_item.config.get("ts_fresh_window_length") or 0))
+        except (TypeError, ValueError):
+            return 0
+
+    def __estimate(self, job: models.Job, model_items: typing.List[models.Model]) -> typing.Tuple[int, int]:
+        size = self.__data_handler.estimate_size(job.service_id)
+        if size is None:
+            memory = self.__max_memory // max(1, self.__max_jobs)
+        else:
+            # rolled feature windows grow with the window length
+            window = max(self.__get_window_length(model_item) for model_item in model_items)
+            memory = int(size * self.__memory_factor * (1 + window / 100))
+        cpus = min(self.__grid_threads, len(model_items)) if job.model_ids else 1
+        if size is not None and job.model_ids:
+            # concurrent variants train on their own copy of the data
+            memory += size * cpus
+        return memory, cpus
+
+    def __admit(self, cost: typing.Tuple[int, int]) -> bool:
+        if not self.__job_costs:
+            return True
+        memory = sum(job_cost[0] for job_cost in self.__job_costs.values()) + cost[0]
+        cpus = sum(job_cost[1] for job_cost in self.__job_costs.values()) + cost[1]
+        return (not self.__max_memory or memory <= self.__max_memory) and cpus <= self.__max_cpus
+
+    def __next_job(self) -> typing.Optional[str]:
+        with self.__lock:
+            candidate = None
+            for job_ids in self.__job_queues.values():
+                if candidate is None or self.__job_pool[job_ids[0]].priority > self.__job_pool[candidate].priority:
+                    candidate = job_ids[0]
+            return candidate
+
+    def __dequeue(self, job_id: str) -> bool:
+        with self.__lock:
+            service_id = self.__job_pool[job_id].service_id
+            if job_id not in self.__job_queues.get(service_id, list()):
+                return False
+            self.__job_queues[service_id].remove(job_id)
+            if self.__job_queues[service_id]:
+                self.__job_queues.move_to_end(service_id)
+            else:
+                del self.__job_queues[service_id]
+            return True
+
+    def __rebalance(self):
+        # cores are split between running jobs according to their cpu cost, jobs share cores if there are too few
+        if not self.__cores or not self.__job_costs:
+            return
+        job_ids = list(self.__job_costs.keys())
+        weights = [max(1, self.__job_costs[job_id][1]) for job_id in job_ids]
+        shares = [max(1, len(self.__cores) * weight // sum(weights)) for weight in weights]
+        for i in range(max(0, len(self.__cores) - sum(shares))):
+            shares[i % len(shares)] += 1
+        pos = 0
+        for job_id, share in zip(job_ids, shares):
+            cores = [self.__cores[(pos + i) % len(self.__cores)] for i in range(min(share, len(self.__cores)))]
+            pos += share
+            if self.__job_cores.get(job_id) == cores:
+                continue
+            self.__job_cores[job_id] = cores
+            set_affinity(self.__worker_pool[job_id].pid, cores)
+            logger.debug("assigned cpu cores {} to job '{}'".format(cores, job_id))
+
+    def __dispatch(self):
+        worker = self.__workers.get_idle(self.__worker_pool.values())
+        while worker:
+            job_id = self.__next_job()
+            if not job_id:
+                return
+            job = self.__job_pool[job_id]
+            model_items = self.__get_model_items(job_id)
+            if model_items is None:
+                continue
+            try:
+                cost = self.__estimate(job, model_items)
+            except Exception as ex:
+                self.__fail(job_id, "estimating resources failed - {}".format(ex))
+                continue
+            if not self.__admit(cost):
+                # waiting for resources instead of skipping the job prevents starvation of large jobs
+                logger.debug("job '{}' waiting for resources".format(job_id))
+                return
+            if not self.__dequeue(job_id):
+                continue
+            self.__job_costs[job_id] = cost
+            self.__job_started[job_id] = time.monotonic()
+            self.__worker_pool[job_id] = worker
+            self.__rebalance()
+            worker.conn.send((job, model_items, self.__job_cores.get(job_id)))
+            job.status = models.JobStatus.running
+            self.__db_handler.put(b"queue-", job_id.encode(), json.dumps(dict(job)).encode())
+            worker = self.__workers.get_idle(self.__worker_pool.values())
+
     def run(self):
         while True:
             try:
-                if len(self.__worker_pool) < self.__max_jobs:
+                # workers are started in advance and reused for subsequent jobs
+                while len(self.__workers) < self.__max_jobs:
+                    self.__workers.add()
+                try:
+                    self.__dispatch()
+                except Exception as ex:
+                    logger.error("dispatching jobs failed - {}".format(ex))
+                busy = {worker: job_id for job_id, worker in self.__worker_pool.items()}
+                # wakes up on new jobs, results and terminated workers, the timeout is a fallback
+                ready = multiprocessing.connection.wait(
+                    [self.__wakeup_r] + [worker.conn for worker in busy] + [worker.sentinel for worker in self.__workers],
+                    timeout=self.__get_timeout()
+                )
+                if self.__wakeup_r in ready:
                     try:
-                        job_id = self.__job_queue.get(timeout=self.__check_delay)
-                        worker = Worker(
-                            job=self.__job_pool[job_id],
-                            model_item=models.Model(json.loads(self.__db_handler.get(b"models-", self.__job_pool[job_id].model_id.encode()))),
-                            data_handler=self.__data_handler
-                        )
-                        self.__worker_pool[job_id] = worker
-                        worker.start()
-                    except queue.Empty:
+                        while os.read(self.__wakeup_r, 4096):
+                            pass
+                    except BlockingIOError:
                         pass
-                else:
-                    time.sleep(self.__check_delay)
-                for job_id in list(self.__worker_pool.keys()):
-                    if not self.__worker_pool[job_id].is_alive():
-                        try:
-                            res = self.__worker_pool[job_id].result.get(timeout=5)
-                            self.__db_handler.put(b"jobs-", res.job.id.encode(), json.dumps(dict(res.job)).encode())
-                            if not res.error:
-                                self.__db_handler.put(b"models-", res.model_item.id.encode(), json.dumps(dict(res.model_item)).encode())
-                        except queue.Empty:
-                            logger.error("job '{}' quit with exitcode '{}'".format(job_id, self.__worker_pool[job_id].exitcode))
-                        self.__worker_pool[job_id].close()
-                        del self.__worker_pool[job_id]
-                        del self.__job_pool[job_id]
+                for worker, job_id in busy.items():
+                    self.__check_worker(job_id)
+                self.__check_aborts()
+                self.__check_leases()
+                for worker in list(self.__workers):
+                    if worker not in busy and not worker.is_alive():
+                        logger.warning("'{}' quit with exitcode '{}'".format(worker.name, worker.exitcode))
+                        self.__workers.remove(worker)
             except Exception as ex:
                 logger.error("job handling failed - {}".format(ex))
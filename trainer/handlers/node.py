@@ -0,0 +1,217 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("Node",)
+
+
+from ..logger import getLogger
+from .. import models
+from . import Data, Storage
+from .jobs import Worker, WorkerPool, Result
+import requests
+import typing
+import time
+import base64
+import multiprocessing.connection
+
+
+logger = getLogger(__name__.split(".", 1)[-1])
+
+
+class Node:
+    __timeout = 30
+
+    def __init__(self, trainer_url: str, name: str, data_handler: Data, storage_handler: Storage, max_jobs: int, poll_delay: typing.Union[int, float], job_max_memory: int, compact_data: bool, cache_features: bool, incremental_features: bool, track_data_size: bool, grid_threads: int, worker_max_jobs: int, worker_max_memory: int):
+        self.__trainer_url = trainer_url
+        self.__name = name
+        self.__storage_handler = storage_handler
+        self.__max_jobs = max_jobs
+        self.__poll_delay = poll_delay
+        self.__session = requests.Session()
+        self.__leases: typing.Dict[str, Worker] = dict()
+        self.__lease_jobs: typing.Dict[str, str] = dict()
+        self.__renewals: typing.Dict[str, typing.Tuple[float, float]] = dict()
+        self.__results: typing.Dict[str, typing.List[Result]] = dict()
+        self.__workers = WorkerPool(
+            data_handler=data_handler,
+            storage_handler=storage_handler,
+            compact_data=compact_data,
+            cache_features=cache_features,
+            incremental_features=incremental_features,
+            track_data_size=track_data_size,
+            grid_threads=grid_threads,
+            max_jobs=worker_max_jobs,
+            max_memory=worker_max_memory * 1048576,
+            job_max_memory=job_max_memory * 1048576
+        )
+        self.__next_claim = 0
+
+    def __request(self, method: str, path: str, **kwargs) -> requests.Response:
+        return self.__session.request(method=method, url="{}/{}".format(self.__trainer_url, path), timeout=self.__timeout, **kwargs)
+
+    def __remove_lease(self, lease_id: str) -> Worker:
+        del self.__lease_jobs[lease_id]
+        del self.__renewals[lease_id]
+        for res in self.__results.pop(lease_id, list()):
+            self.__discard(res)
+        return self.__leases.pop(lease_id)
+
+    def __claim(self):
+        worker = self.__workers.get_idle(self.__leases.values())
+        while worker and time.monotonic() >= self.__next_claim:
+            try:
+                resp = self.__request("post", "leases", json={"worker": self.__name})
+                if not resp.ok:
+                    raise RuntimeError(resp.status_code)
+            except Exception as ex:
+                logger.error("claiming job failed - {}".format(ex))
+                self.__next_claim = time.monotonic() + self.__poll_delay
+                return
+            if resp.status_code == 204:
+                self.__next_claim = time.monotonic() + self.__poll_delay
+                return
+            lease = models.Lease(resp.json())
+            self.__leases[lease.id] = worker
+            self.__lease_jobs[lease.id] = lease.job["id"]
+            # leases are renewed well before they expire to tolerate delayed requests
+            self.__renewals[lease.id] = (time.monotonic() + lease.lease_time / 3, lease.lease_time / 3)
+            worker.conn.send((models.Job(lease.job), [models.Model(model_item) for model_item in lease.models], None))
+            logger.debug("claimed job '{}'".format(lease.job["id"]))
+            worker = self.__workers.get_idle(self.__leases.values())
+
+    def __send_result(self, lease_id: str, res: Result) -> bool:
+        model_item = dict(res.model_item) if res.model_item else None
+        if res.data_path:
+            # models are stored by the trainer, the local file is kept until the upload succeeded
+            model_item["data"] = base64.standard_b64encode(self.__storage_handler.read_file(res.data_path)).decode()
+        result = models.JobResult(
+            model_item=model_item,
+            variant=dict(res.variant) if res.variant else None,
+            job=dict(res.job) if res.job else None,
+            error=res.error
+        )
+        resp = self.__request("post", "leases/{}".format(lease_id), json=dict(result))
+        if 400 <= resp.status_code < 500:
+            # the lease is gone or the result was rejected, retrying would not help
+            self.__discard(res)
+            return False
+        if not resp.ok:
+            raise RuntimeError(resp.status_code)
+        self.__discard(res)
+        deadline, interval = self.__renewals[lease_id]
+        self.__renewals[lease_id] = (time.monotonic() + interval, interval)
+        return True
+
+    def __discard(self, res: Result):
+        if res.data_path:
+            self.__storage_handler.remove_file(res.data_path)
+            res.data_path = None
+
+    def __check_worker(self, lease_id: str):
+        worker = self.__leases[lease_id]
+        results = self.__results.setdefault(lease_id, list())
+        finished = any(res.job for res in results)
+        try:
+            while not finished and worker.conn.poll():
+                res = worker.conn.recv()
+                results.append(res)
+                finished = bool(res.job)
+        except (EOFError, OSError):
+            pass
+        if not finished and not worker.is_alive():
+            logger.error("job '{}' quit with exitcode '{}'".format(self.__lease_jobs[lease_id], worker.exitcode))
+            res = Result()
+            res.job = models.Job(id=self.__lease_jobs[lease_id], status=models.JobStatus.failed, reason="worker quit with exitcode '{}'".format(worker.exitcode))
+            res.error = True
+            res.retire = True
+            results.append(res)
+        # results are sent in order, unsent results are retried and the lease is kept until the job result was sent
+        while results:
+            try:
+                if not self.__send_result(lease_id, results[0]):
+                    logger.warning("lease of job '{}' lost or result rejected - stopping job".format(self.__lease_jobs[lease_id]))
+                    self.__workers.remove(self.__remove_lease(lease_id), stop=True)
+                    return
+            except Exception as ex:
+                logger.error("sending result of job '{}' failed - {}".format(self.__lease_jobs[lease_id], ex))
+                return
+            res = results.pop(0)
+            if res.job:
+                self.__remove_lease(lease_id)
+                if res.retire:
+                    self.__workers.remove(worker)
+                return
+
+    def __renew(self):
+        for lease_id, (deadline, interval) in list(self.__renewals.items()):
+            if time.monotonic() < deadline:
+                continue
+            try:
+                resp = self.__request("put", "leases/{}".format(lease_id))
+                if resp.status_code == 404:
+                    # the job was aborted or the lease expired and the job was queued again
+                    logger.warning("lease of job '{}' lost - stopping job".format(self.__lease_jobs[lease_id]))
+                    self.__workers.remove(self.__remove_lease(lease_id), stop=True)
+                    continue
+                if not resp.ok:
+                    raise RuntimeError(resp.status_code)
+                self.__renewals[lease_id] = (time.monotonic() + interval, interval)
+            except Exception as ex:
+                logger.warning("renewing lease of job '{}' failed - {}".format(self.__lease_jobs[lease_id], ex))
+
+    def __get_timeout(self) -> float:
+        deadlines = [deadline for deadline, _ in self.__renewals.values()]
+        if self.__workers.get_idle(self.__leases.values()):
+            deadlines.append(self.__next_claim)
+        if not deadlines:
+            return self.__poll_delay
+        return min(self.__poll_delay, max(0, min(deadlines) - time.monotonic()))
+
+    def __shutdown(self):
+        # released jobs are queued again immediately instead of after their leases expired
+        for lease_id in list(self.__leases.keys()):
+            try:
+                self.__request("delete", "leases/{}".format(lease_id))
+            except Exception as ex:
+                logger.warning("releasing lease of job '{}' failed - {}".format(self.__lease_jobs[lease_id], ex))
+        for worker in list(self.__workers):
+            self.__workers.remove(worker, stop=True)
+
+    def run(self):
+        logger.info("'{}' taking jobs from '{}'".format(self.__name, self.__trainer_url))
+        try:
+            while True:
+                try:
+                    while len(self.__workers) < self.__max_jobs:
+                        self.__workers.add()
+                    self.__claim()
+                    busy = list(self.__leases.items())
+                    multiprocessing.connection.wait(
+                        [worker.conn for _, worker in busy] + [worker.sentinel for worker in self.__workers],
+                        timeout=self.__get_timeout()
+                    )
+                    for lease_id, worker in busy:
+                        if self.__leases.get(lease_id) is worker:
+                            self.__check_worker(lease_id)
+                    self.__renew()
+                    for worker in list(self.__workers):
+                        if worker not in self.__leases.values() and not worker.is_alive():
+                            logger.warning("'{}' quit with exitcode '{}'".format(worker.name, worker.exitcode))
+                            self.__workers.remove(worker)
+                except Exception as ex:
+                    logger.error("job handling failed - {}".format(ex))
+        finally:
+            self.__shutdown()
@@ -21,6 +21,10 @@ from ..logger import getLogger
 from .. import models
 from . import DB, Jobs, Data
 import threading
+import random
+import concurrent.futures
+import collections
+import typing
 import time
 import json
 
@@ -29,25 +33,85 @@ logger = getLogger(__name__.split(".", 1)[-1])
 
 
 class Scheduler(threading.Thread):
-    def __init__(self, job_handler: Jobs, db_handler: DB, data_handler: Data, delay: int):
+    def __init__(self, job_handler: Jobs, db_handler: DB, data_handler: Data, delay: int, max_requests: int, budget: int, priority: int, min_growth: typing.Union[int, float]):
         super().__init__(name="scheduler-handler", daemon=True)
         self.__job_handler = job_handler
         self.__db_handler = db_handler
         self.__data_handler = data_handler
         self.__delay = delay
+        self.__max_requests = max_requests
+        self.__budget = budget
+        self.__priority = priority
+        self.__min_growth = min_growth
+
+    def __get_services(self) -> typing.Dict[str, typing.List[models.Model]]:
+        services = collections.defaultdict(list)
+        for model_id in self.__db_handler.list_keys(b"models-"):
+            try:
+                model = models.Model(json.loads(self.__db_handler.get(b"models-", model_id.encode())))
+                services[model.service_id].append(model)
+            except Exception as ex:
+                logger.error("loading model '{}' failed - {}".format(model_id, ex))
+        return services
+
+    def __get_stale(self, service_id: str, model_items: typing.List[models.Model]) -> typing.List[models.Model]:
+        metadata = self.__data_handler.get_metadata(service_id)
+        model_items = [
+            model_item for model_item in model_items
+            if model_item.data_checksum != metadata.checksum and not self.__job_handler.find_job(model_item.id)
+        ]
+        if model_items and self.__min_growth:
+            size = self.__data_handler.get_size(source_id=service_id, metadata=metadata)
+            if size is not None:
+                # models trained with data of unknown size are always retrained
+                model_items = [
+                    model_item for model_item in model_items
+                    if not model_item.data_size or abs(size - model_item.data_size) >= model_item.data_size * self.__min_growth / 100
+                ]
+        return model_items
+
+    def __plan(self) -> typing.List[typing.Tuple[str, typing.List[str]]]:
+        services = self.__get_services()
+        stale = dict()
+        # metadata is retrieved once per service, variants of a service are trained in one pass
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.__max_requests), thread_name_prefix="scheduler") as executor:
+            futures = {executor.submit(self.__get_stale, service_id, model_items): service_id for service_id, model_items in services.items()}
+            for future in concurrent.futures.as_completed(futures):
+                service_id = futures[future]
+                try:
+                    model_items = future.result()
+                    if model_items:
+                        stale[service_id] = model_items
+                except Exception as ex:
+                    logger.error("checking models of '{}' failed - {}".format(service_id, ex))
+        # the oldest models are retrained first, models exceeding the budget are retrained in later cycles
+        budget = self.__budget or sum(len(model_items) for model_items in stale.values())
+        plan = list()
+        for service_id, model_items in sorted(stale.items(), key=lambda item: min(model_item.created or "" for model_item in item[1])):
+            if budget < 1:
+                logger.debug("budget exhausted, deferring models of '{}'".format(service_id))
+                continue
+            model_items = sorted(model_items, key=lambda model_item: model_item.created or "")[:budget]
+            budget -= len(model_items)
+            plan.append((service_id, [model_item.id for model_item in model_items]))
+        return plan
 
     def run(self) -> None:
+        time.sleep(self.__delay)
         while True:
+            started = time.monotonic()
             try:
-                time.sleep(self.__delay)
                 logger.debug("scheduling jobs ...")
-                for model_id in self.__db_handler.list_keys(b"model-"):
+                plan = self.__plan()
+                # jobs are spread over the cycle with random offsets to avoid bursts
+                slot = self.__delay / max(1, len(plan))
+                for i, (service_id, model_ids) in enumerate(plan):
+                    time.sleep(max(0, started + (i + random.random()) * slot - time.monotonic()))
                     try:
-                        model = models.Model(json.loads(self.__db_handler.get(b"model-", model_id.encode())))
-                        meta_data = self.__data_handler.get_metadata(model.service_id)
-                        if meta_data.checksum != model.data_checksum:
-                            self.__job_handler.create(model_id=model_id)
+                        logger.debug("scheduling jobs for {} models of '{}'".format(len(model_ids), service_id))
+                        self.__job_handler.create_grid(model_ids=model_ids, priority=self.__priority)
                     except Exception as ex:
-                        logger.error("scheduling job for model '{}' failed - {}".format(model_id, ex))
+                        logger.error("scheduling jobs for '{}' failed - {}".format(service_id, ex))
             except Exception as ex:
                 logger.error("scheduling jobs failed - {}".format(ex))
+            time.sleep(max(0, started + self.__delay - time.monotonic()))
@@ -0,0 +1,166 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("Storage",)
+
+
+from ..logger import getLogger
+from .. import event_prediction_trainer, util
+import typing
+import gzip
+import hashlib
+import os
+import re
+
+try:
+    import joblib
+except ImportError:
+    joblib = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+logger = getLogger(__name__.split(".", 1)[-1])
+
+
+class Storage:
+    __chunk_size = 1048576
+    __formats = ("pickle", "joblib")
+    __levels = {"none": 0, "gzip": 6, "zstd": 3, "lz4": 0}
+    __content_types = {"gzip": "application/gzip", "zstd": "application/zstd"}
+    __id_pattern = re.compile("[0-9a-f]{64}")
+
+    def __init__(self, st_path: str, data_format: str, codec: str, level: int):
+        if data_format not in self.__formats:
+            raise RuntimeError("unknown model format '{}'".format(data_format))
+        if codec not in self.__levels:
+            raise RuntimeError("unknown model codec '{}'".format(codec))
+        if data_format == "joblib" and not joblib:
+            raise RuntimeError("model format 'joblib' requires joblib")
+        if codec == "zstd" and not zstandard:
+            raise RuntimeError("model codec 'zstd' requires zstandard")
+        if codec == "lz4" and not lz4:
+            raise RuntimeError("model codec 'lz4' requires lz4")
+        self.__st_path = st_path
+        self.__tmp_path = os.path.join(st_path, "tmp")
+        self.data_format = data_format
+        self.codec = codec
+        self.__level = level or self.__levels[codec]
+        os.makedirs(self.__tmp_path, exist_ok=True)
+        util.remove_tmp_files(self.__tmp_path)
+
+    @classmethod
+    def get_content_type(cls, codec: typing.Optional[str]) -> str:
+        # models stored before the codec was recorded are gzip compressed
+        return cls.__content_types.get(codec or "gzip", "application/octet-stream")
+
+    def __get_path(self, model_id: str, digest: str) -> str:
+        # only ids generated by configs are used as file names, files never change since the digest is part of the name
+        if not self.__id_pattern.fullmatch(model_id) or not self.__id_pattern.fullmatch(digest or ""):
+            raise KeyError(model_id)
+        return os.path.join(self.__st_path, "{}-{}".format(model_id, digest))
+
+    def __get_tmp_path(self) -> str:
+        return util.get_tmp_path(self.__tmp_path, "tmp")
+
+    def remove_tmp_files(self, pid: int):
+        util.remove_tmp_files(self.__tmp_path, pid)
+
+    def __open_writer(self, file: typing.BinaryIO) -> typing.BinaryIO:
+        if self.codec == "gzip":
+            return gzip.GzipFile(fileobj=file, mode="wb", compresslevel=self.__level, mtime=0)
+        if self.codec == "zstd":
+            return zstandard.ZstdCompressor(level=self.__level, threads=-1).stream_writer(file, closefd=False)
+        if self.codec == "lz4":
+            return lz4.frame.LZ4FrameFile(file, mode="wb", compression_level=self.__level)
+        return file
+
+    def __get_digest(self, path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(self.__chunk_size), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def write(self, obj: typing.Any) -> typing.Tuple[str, str]:
+        # serializes directly into a temporary file, the file is moved into place via commit
+        path = self.__get_tmp_path()
+        try:
+            with open(path, "wb") as file:
+                with self.__open_writer(file) as writer:
+                    if self.data_format == "joblib":
+                        # numpy arrays are written without creating intermediate copies
+                        joblib.dump(obj, writer)
+                    else:
+                        writer.write(event_prediction_trainer.pipeline.clf_to_pickle_bytes(obj))
+            return path, self.__get_digest(path)
+        except Exception:
+            os.remove(path)
+            raise
+
+    def commit(self, model_id: str, digest: str, path: str):
+        os.replace(path, self.__get_path(model_id, digest))
+
+    def read_file(self, path: str) -> bytes:
+        with open(path, "rb") as file:
+            return file.read()
+
+    def remove_file(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def put(self, model_id: str, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        target = self.__get_path(model_id, digest)
+        path = self.__get_tmp_path()
+        with open(path, "wb") as file:
+            file.write(data)
+        os.replace(path, target)
+        return digest
+
+    def open(self, model_id: str, digest: str) -> typing.BinaryIO:
+        try:
+            return open(self.__get_path(model_id, digest), "rb")
+        except FileNotFoundError:
+            raise KeyError(model_id)
+
+    def read(self, model_id: str, digest: str) -> bytes:
+        with self.open(model_id, digest) as file:
+            return file.read()
+
+    def delete(self, model_id: str, digest: str):
+        try:
+            os.remove(self.__get_path(model_id, digest))
+        except FileNotFoundError:
+            pass
+
+    def list_files(self) -> typing.List[typing.Tuple[str, str]]:
+        files = list()
+        for file in os.listdir(self.__st_path):
+            model_id, _, digest = file.partition("-")
+            if self.__id_pattern.fullmatch(model_id) and self.__id_pattern.fullmatch(digest):
+                files.append((model_id, digest))
+        return files
@@ -18,7 +18,7 @@
 import simple_struct
 
 
-__all__ = ("Job", "JobStatus", "Model", "ModelResponse", "ModelRequest", "MetaData")
+__all__ = ("Job", "JobStatus", "JobVariant", "JobResult", "Lease", "Model", "ModelResponse", "ModelRequest", "MetaData")
 
 
 class JobStatus:
@@ -35,9 +35,37 @@ class Job:
     created = None
     status = JobStatus.pending
     model_id = None
+    model_ids = None
+    variants = None
+    service_id = None
+    priority = 0
+    reason = None
+
+
+@simple_struct.structure
+class JobVariant:
+    model_id = None
+    status = JobStatus.pending
     reason = None
 
 
+@simple_struct.structure
+class JobResult:
+    model_item = None
+    variant = None
+    job = None
+    error = False
+
+
+@simple_struct.structure
+class Lease:
+    id = None
+    worker = None
+    job = None
+    models = None
+    lease_time = None
+
+
 @simple_struct.structure
 class Model:
     id = None
@@ -48,6 +76,11 @@ class Model:
     default_values = None
     service_id = None
     time_field = None
+    data_checksum = None
+    data_size = None
+    data_digest = None
+    data_format = None
+    data_codec = None
 
 
 @simple_struct.structure
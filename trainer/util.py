@@ -14,11 +14,23 @@
    limitations under the License.
 """
 
-__all__ = ("Decompress", )
+__all__ = ("Decompress", "get_tmp_path", "remove_tmp_file", "remove_tmp_files", "copy_file", "write_frame", "read_frame", "read_csv")
 
 
+from .logger import getLogger
 import zlib
 import typing
+import shutil
+import errno
+import io
+import os
+import uuid
+import json
+import numpy
+import pandas
+
+
+logger = getLogger(__name__.split(".", 1)[-1])
 
 
 class Decompress:
@@ -39,3 +51,199 @@ class Decompress:
 
     def __getattr__(self, attr):
         return getattr(self.__io_obj, attr)
+
+
+def get_tmp_path(path: str, suffix: str) -> str:
+    # the pid allows to detect files left behind by terminated processes
+    return os.path.join(path, "{}-{}.{}".format(os.getpid(), uuid.uuid4().hex, suffix))
+
+
+def remove_tmp_file(path: str, file: str):
+    try:
+        if os.path.isdir(os.path.join(path, file)):
+            shutil.rmtree(os.path.join(path, file))
+        else:
+            os.remove(os.path.join(path, file))
+    except Exception as ex:
+        logger.warning("could not remove temporary file '{}' - {}".format(file, ex))
+
+
+def remove_tmp_files(path: str, pid: typing.Optional[int] = None):
+    # removes files of the given process or, without a pid, of processes that no longer exist
+    for file in os.listdir(path):
+        try:
+            owner = int(file.split("-", 1)[0])
+        except ValueError:
+            continue
+        if pid is None:
+            try:
+                os.kill(owner, 0)
+                continue
+            except ProcessLookupError:
+                pass
+            except Exception:
+                continue
+        elif owner != pid:
+            continue
+        remove_tmp_file(path, file)
+
+
+def copy_file(src: typing.BinaryIO, dst: typing.BinaryIO, block_size: int = 8388608):
+    # copies in kernel space if possible, e.g. from a file to a pipe
+    try:
+        in_fd = src.fileno()
+        out_fd = dst.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        shutil.copyfileobj(src, dst)
+        return
+    dst.flush()
+    offset = src.tell()
+    start = offset
+    while True:
+        try:
+            sent = os.sendfile(out_fd, in_fd, offset, block_size)
+        except OSError as ex:
+            if offset == start and ex.errno in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                shutil.copyfileobj(src, dst)
+                return
+            raise ex
+        if not sent:
+            break
+        offset += sent
+    src.seek(offset)
+
+
+def __write_values(values: pandas.Index, path: str, name: str) -> dict:
+    dtype = values.dtype
+    if isinstance(dtype, numpy.dtype) and dtype.kind in "biufcmM":
+        numpy.save(os.path.join(path, "{}.npy".format(name)), values.to_numpy())
+        return {"kind": "array"}
+    if isinstance(dtype, pandas.CategoricalDtype):
+        numpy.save(os.path.join(path, "{}.npy".format(name)), values.codes)
+        numpy.save(os.path.join(path, "{}.cat.npy".format(name)), values.categories.to_numpy(dtype=object), allow_pickle=True)
+        return {"kind": "categorical", "ordered": bool(dtype.ordered)}
+    if isinstance(dtype, pandas.DatetimeTZDtype):
+        numpy.save(os.path.join(path, "{}.npy".format(name)), values.tz_convert("UTC").tz_localize(None).to_numpy())
+        return {"kind": "datetimetz", "tz": str(dtype.tz)}
+    codes, uniques = pandas.factorize(values)
+    numpy.save(os.path.join(path, "{}.npy".format(name)), codes)
+    numpy.save(os.path.join(path, "{}.cat.npy".format(name)), uniques.to_numpy(dtype=object), allow_pickle=True)
+    return {"kind": "factorized", "dtype": str(dtype)}
+
+
+def __read_values(meta: dict, path: str, name: str):
+    # copy-on-write mappings share pages with other processes but stay writable
+    values = numpy.load(os.path.join(path, "{}.npy".format(name)), mmap_mode="c").view(numpy.ndarray)
+    if meta["kind"] == "array":
+        return values
+    if meta["kind"] == "datetimetz":
+        return pandas.DatetimeIndex(values).tz_localize("UTC").tz_convert(meta["tz"])
+    categories = numpy.load(os.path.join(path, "{}.cat.npy".format(name)), allow_pickle=True)
+    if meta["kind"] == "categorical":
+        return pandas.Categorical.from_codes(values, categories=categories, ordered=meta["ordered"])
+    restored = categories.take(values, mode="clip")
+    restored[values < 0] = numpy.nan
+    return pandas.Series(restored, dtype=meta["dtype"], copy=False)
+
+
+def __as_series(values, index: pandas.Index) -> pandas.Series:
+    if isinstance(values, pandas.Series):
+        values.index = index
+        return values
+    return pandas.Series(values, index=index, copy=False)
+
+
+def __write_index(index: pandas.Index, path: str) -> dict:
+    if isinstance(index, pandas.MultiIndex):
+        return {
+            "kind": "multi",
+            "levels": [
+                dict(__write_values(index.get_level_values(pos), path, "index{}".format(pos)), name=index.names[pos])
+                for pos in range(index.nlevels)
+            ]
+        }
+    return dict(__write_values(index, path, "index"), name=index.name)
+
+
+def __read_index(meta: dict, path: str) -> pandas.Index:
+    if meta["kind"] == "multi":
+        return pandas.MultiIndex.from_arrays(
+            [__read_values(level, path, "index{}".format(pos)) for pos, level in enumerate(meta["levels"])],
+            names=[level["name"] for level in meta["levels"]]
+        )
+    return pandas.Index(__read_values(meta, path, "index"), name=meta["name"], copy=False)
+
+
+def write_frame(df: pandas.DataFrame, path: str):
+    os.makedirs(path)
+    meta = {
+        "index": __write_index(df.index, path),
+        "columns": [
+            dict(__write_values(pandas.Index(df.iloc[:, pos], dtype=df.dtypes.iloc[pos]), path, "c{}".format(pos)), name=df.columns[pos])
+            for pos in range(len(df.columns))
+        ]
+    }
+    with open(os.path.join(path, "frame.json"), "w") as file:
+        json.dump(meta, file)
+
+
+def read_frame(path: str) -> pandas.DataFrame:
+    with open(os.path.join(path, "frame.json"), "r") as file:
+        meta = json.load(file)
+    index = __read_index(meta["index"], path)
+    df = pandas.DataFrame(
+        {
+            pos: __as_series(__read_values(meta["columns"][pos], path, "c{}".format(pos)), index)
+            for pos in range(len(meta["columns"]))
+        },
+        copy=False
+    )
+    df.columns = [column["name"] for column in meta["columns"]]
+    return df
+
+
+def __compact_values(values: pandas.Series, categorical: bool):
+    if categorical or not (isinstance(values.dtype, numpy.dtype) and values.dtype.kind in "biuf"):
+        return pandas.Categorical(values)
+    if values.dtype.kind == "f":
+        return values.to_numpy(dtype=numpy.float32)
+    return values.to_numpy()
+
+
+def __concat_values(parts: list):
+    if any(isinstance(part, pandas.Categorical) for part in parts):
+        categoricals = [pandas.Categorical(part) for part in parts]
+        if len(set(str(part.categories.dtype) for part in categoricals)) > 1:
+            categoricals = [pandas.Categorical(numpy.asarray(part, dtype=object)) for part in categoricals]
+        return pandas.api.types.union_categoricals(categoricals)
+    if any(part.dtype.kind == "f" for part in parts):
+        dtype = numpy.float32
+    elif any(part.dtype.kind in "iu" for part in parts):
+        # integers keep at least int64, narrower or unsigned types change the results of arithmetic in the pipeline
+        dtype = numpy.result_type(numpy.int64, *(part.dtype for part in parts))
+    else:
+        dtype = parts[0].dtype
+    return numpy.concatenate(parts).astype(dtype, copy=False)
+
+
+def read_csv(path: str, time_field: str, columns: typing.Optional[list] = None, default_values: typing.Optional[dict] = None, chunk_size: int = 16384) -> pandas.DataFrame:
+    # values are converted to compact types chunk by chunk, so parser overhead is bounded by the chunk size
+    categorical = {key for key, value in (default_values or dict()).items() if isinstance(value, str)}
+    index_parts = list()
+    parts = dict()
+    with pandas.read_csv(path, chunksize=chunk_size, dtype={key: str for key in categorical}) as reader:
+        for chunk in reader:
+            index_parts.append(pandas.DatetimeIndex(pandas.to_datetime(chunk.pop(time_field))))
+            for key in chunk.columns:
+                parts.setdefault(key, list()).append(__compact_values(chunk[key], key in categorical))
+    if not index_parts:
+        raise RuntimeError("no data in '{}'".format(path))
+    index = index_parts[0].append(index_parts[1:]).rename(time_field)
+    del index_parts
+    keys = [key for key in columns or parts.keys() if key in parts]
+    keys += [key for key in parts if key not in keys]
+    data = dict()
+    for key in keys:
+        # parts are released column by column to keep at most one extra column in memory
+        data[key] = __as_series(__concat_values(parts.pop(key)), index)
+    return pandas.DataFrame(data, copy=False)
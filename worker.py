@@ -0,0 +1,67 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from trainer.logger import initLogger
+from trainer.configuration import conf
+from trainer import handlers
+import signal
+import socket
+import sys
+import os
+
+
+def handle_sigterm(signo, stack_frame):
+    sys.exit(0)
+
+
+initLogger(conf.Logger.level)
+
+data_handler = handlers.Data(
+    st_path=conf.Storage.data_cache_path,
+    data_api_url=conf.Data.api_url,
+    max_downloads=conf.Data.max_downloads,
+    max_prefetches=0,
+    cache_streams=conf.Data.cache_streams,
+    cache_frames=conf.Data.cache_frames,
+    cache_size=conf.Data.cache_size
+)
+storage_handler = handlers.Storage(
+    st_path=conf.Storage.models_path,
+    data_format=conf.Models.format,
+    codec=conf.Models.codec,
+    level=conf.Models.level
+)
+node = handlers.Node(
+    trainer_url=conf.Node.trainer_url,
+    name=conf.Node.name or "{}-{}".format(socket.gethostname(), os.getpid()),
+    data_handler=data_handler,
+    storage_handler=storage_handler,
+    max_jobs=conf.Node.max_num,
+    poll_delay=conf.Node.poll,
+    job_max_memory=conf.Jobs.job_max_memory,
+    compact_data=conf.Jobs.compact_data,
+    cache_features=conf.Jobs.cache_features,
+    incremental_features=conf.Jobs.incremental_features,
+    track_data_size=conf.Jobs.skd_min_growth > 0,
+    grid_threads=conf.Jobs.grid_threads,
+    worker_max_jobs=conf.Jobs.worker_max_jobs,
+    worker_max_memory=conf.Jobs.worker_max_memory
+)
+
+signal.signal(signal.SIGTERM, handle_sigterm)
+signal.signal(signal.SIGINT, handle_sigterm)
+data_handler.start()
+node.run()